@@ -0,0 +1,29 @@
+"""Message history index
+
+Revision ID: 5d2a9c1e7b43
+Revises: 0378fda3d347
+Create Date: 2026-10-17 10:12:31.482913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2a9c1e7b43'
+down_revision: Union[str, None] = '0378fda3d347'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # keyset pagination walks (creation_date, message_id) within a room
+    op.create_index('idx_message__room_creation', 'message', ['room', 'creation_date', 'message_id'], unique=False)
+    op.drop_index('idx_message__room', table_name='message')
+
+
+def downgrade() -> None:
+    op.create_index('idx_message__room', 'message', ['room'], unique=False)
+    op.drop_index('idx_message__room_creation', table_name='message')
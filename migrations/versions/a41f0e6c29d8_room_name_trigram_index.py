@@ -0,0 +1,29 @@
+"""Room name trigram index
+
+Revision ID: a41f0e6c29d8
+Revises: 5d2a9c1e7b43
+Create Date: 2026-10-17 11:40:05.117302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a41f0e6c29d8'
+down_revision: Union[str, None] = '5d2a9c1e7b43'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # lets room_name ILIKE '%x%' use an index instead of scanning the table
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('idx_room__room_name_trgm', 'room', ['room_name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'room_name': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('idx_room__room_name_trgm', table_name='room')
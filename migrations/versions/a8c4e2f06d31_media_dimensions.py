@@ -0,0 +1,36 @@
+"""Media dimensions and duration
+
+Revision ID: a8c4e2f06d31
+Revises: f1a9d3e5b724
+Create Date: 2026-10-17 19:05:27.774015
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a8c4e2f06d31'
+down_revision: Union[str, None] = 'f1a9d3e5b724'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('message', sa.Column('media_width', sa.Integer(), nullable=True))
+    op.add_column('message', sa.Column('media_height', sa.Integer(), nullable=True))
+    op.add_column('message', sa.Column('media_duration', sa.Float(), nullable=True))
+    op.add_column('media_object', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('media_object', sa.Column('height', sa.Integer(), nullable=True))
+    op.add_column('media_object', sa.Column('duration', sa.Float(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('media_object', 'duration')
+    op.drop_column('media_object', 'height')
+    op.drop_column('media_object', 'width')
+    op.drop_column('message', 'media_duration')
+    op.drop_column('message', 'media_height')
+    op.drop_column('message', 'media_width')
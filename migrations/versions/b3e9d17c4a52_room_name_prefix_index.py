@@ -0,0 +1,27 @@
+"""Room name prefix index
+
+Revision ID: b3e9d17c4a52
+Revises: a8c4e2f06d31
+Create Date: 2026-10-17 21:14:52.406118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3e9d17c4a52'
+down_revision: Union[str, None] = 'a8c4e2f06d31'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # lets lower(room_name) LIKE 'x%' ORDER BY lower(room_name) be answered by an index range scan
+    op.execute('CREATE INDEX idx_room__room_name_prefix ON room (lower(room_name) text_pattern_ops)')
+
+
+def downgrade() -> None:
+    op.drop_index('idx_room__room_name_prefix', table_name='room')
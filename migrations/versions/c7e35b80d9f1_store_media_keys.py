@@ -0,0 +1,39 @@
+"""Store media object keys instead of URLs
+
+Revision ID: c7e35b80d9f1
+Revises: a41f0e6c29d8
+Create Date: 2026-10-17 14:03:47.620118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e35b80d9f1'
+down_revision: Union[str, None] = 'a41f0e6c29d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PUBLIC_BUCKET_URL = 'https://f003.backblazeb2.com/file/gleb-bucket/'
+
+
+def upgrade() -> None:
+    op.execute(
+        f"UPDATE message SET media_file_url = substr(media_file_url, {len(PUBLIC_BUCKET_URL) + 1}) "
+        f"WHERE media_file_url LIKE '{PUBLIC_BUCKET_URL}%'"
+    )
+    # presigned URLs: virtual-hosted (https://bucket.host/key?...) or path style (https://host/bucket/key?...)
+    op.execute(
+        "UPDATE \"user\" SET image_url = regexp_replace(image_url, '^https?://[^/]+/(gleb-bucket/)?([^?]*).*$', '\\2') "
+        "WHERE image_url LIKE 'http%X-Amz-Signature%'"
+    )
+
+
+def downgrade() -> None:
+    op.execute(
+        f"UPDATE message SET media_file_url = '{PUBLIC_BUCKET_URL}' || media_file_url "
+        f"WHERE media_file_url IS NOT NULL AND media_file_url NOT LIKE 'http%'"
+    )
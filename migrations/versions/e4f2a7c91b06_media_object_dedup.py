@@ -0,0 +1,34 @@
+"""Content-addressed media index
+
+Revision ID: e4f2a7c91b06
+Revises: c7e35b80d9f1
+Create Date: 2026-10-17 16:21:09.310457
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4f2a7c91b06'
+down_revision: Union[str, None] = 'c7e35b80d9f1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('media_object',
+    sa.Column('content_hash', sa.String(length=64), nullable=False),
+    sa.Column('file_type', sa.String(length=100), nullable=False),
+    sa.Column('object_key', sa.String(), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('variants', sa.JSON(), nullable=True),
+    sa.Column('creation_date', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('content_hash')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('media_object')
@@ -0,0 +1,26 @@
+"""Message media variants
+
+Revision ID: f1a9d3e5b724
+Revises: e4f2a7c91b06
+Create Date: 2026-10-17 17:48:52.106334
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1a9d3e5b724'
+down_revision: Union[str, None] = 'e4f2a7c91b06'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('message', sa.Column('media_variants', sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('message', 'media_variants')
@@ -3,6 +3,8 @@ from starlette.middleware.cors import CORSMiddleware
 
 import message.router as chat_router
 from auth.base_config import fastapi_users
+from aws.workers import image_workers, video_workers
+from presence import presence
 from router import router
 
 app = FastAPI(title="PolyTex WebChat", version="0.0.1")
@@ -24,4 +26,26 @@ app.include_router(chat_router.router, tags=["chat"])
 
 app.include_router(router, prefix="/api")
 
+
+@app.on_event("startup")
+async def startup():
+    await chat_router.writer.start()
+    await chat_router.manager.start()
+    await chat_router.media_jobs.start()
+    await chat_router.uploads.start()
+    # presence is relayed to the other workers over the chat backplane
+    await presence.start(chat_router.manager.backplane)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await presence.stop()
+    await chat_router.uploads.stop()
+    await chat_router.media_jobs.stop()
+    await chat_router.manager.stop()
+    await chat_router.writer.stop()
+    image_workers.shutdown()
+    video_workers.shutdown()
+
+
 current_user = fastapi_users.current_user()
@@ -1,11 +1,12 @@
 import re
-from typing import Optional, Union
+from typing import Any, Dict, Optional, Union
 
 from fastapi import Depends, Request
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_users import BaseUserManager, IntegerIDMixin, InvalidPasswordException, schemas, exceptions
 from sqlalchemy import select
 
+import identity
 from config import SECRET_AUTH
 from auth.exceptions import InvalidLoginException
 from auth.models import User
@@ -100,6 +101,13 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     async def on_after_request_verify(self, user: User, token: str, request: Optional[Request] = None):
         print(f"Verification requested for user {user.id}. Verification token: {token}")
 
+    async def on_after_update(self, user: User, update_dict: Dict[str, Any], request: Optional[Request] = None):
+        if "username" in update_dict:
+            identity.invalidate_user(user_id=user.id)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        identity.invalidate_user(username=user.username, user_id=user.id)
+
 
 async def get_user_manager(user_db=Depends(get_user_db)):
     yield UserManager(user_db)
@@ -2,6 +2,9 @@ from datetime import datetime
 from typing import Optional
 
 from fastapi_users import schemas
+from pydantic import validator
+
+from aws.utils import media_url
 
 
 class UserRead(schemas.BaseUser[int]):
@@ -16,6 +19,10 @@ class UserRead(schemas.BaseUser[int]):
     is_superuser: bool = False
     is_verified: bool = False
 
+    @validator("image_url")
+    def sign_image_url(cls, value: Optional[str]) -> Optional[str]:
+        return media_url(value)
+
     class Config:
         orm_mode = True
 
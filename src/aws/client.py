@@ -1,10 +1,18 @@
 import boto3
+from botocore.config import Config
 
-from config import ENDPOINT, KEY_ID_RO, APPLICATION_KEY_RO
+from config import ENDPOINT, KEY_ID_RO, APPLICATION_KEY_RO, S3_MAX_POOL_CONNECTIONS, S3_CONNECT_TIMEOUT, \
+    S3_READ_TIMEOUT, S3_MAX_ATTEMPTS
 
 client = boto3.client(
     service_name='s3',
     endpoint_url=ENDPOINT,
     aws_access_key_id=KEY_ID_RO,
-    aws_secret_access_key=APPLICATION_KEY_RO
+    aws_secret_access_key=APPLICATION_KEY_RO,
+    config=Config(
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        connect_timeout=S3_CONNECT_TIMEOUT,
+        read_timeout=S3_READ_TIMEOUT,
+        retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'standard'},
+    )
 )
@@ -41,7 +41,38 @@ SUPPORTED_FILE_TYPES_FORM_AUDIO = {
     key: value for key, value in SUPPORTED_FILE_TYPES_FORM_APPLICATION.items() if 'audio' in key
 }
 
+# what a chat file message may carry: media only, documents are not accepted
+SUPPORTED_FILE_TYPES_FORM_MESSAGE = {
+    **SUPPORTED_FILE_TYPES_FORM_IMAGE, **SUPPORTED_FILE_TYPES_FORM_VIDEO, **SUPPORTED_FILE_TYPES_FORM_AUDIO
+}
+
 # docs types
 SUPPORTED_FILE_TYPES_FROM_DOC = {
     key: value for key, value in SUPPORTED_FILE_TYPES_FORM_APPLICATION.items() if 'application' in key
 }
+
+# only this much of an upload is buffered to sniff its type
+SNIFF_SIZE = 8 * KB
+UPLOAD_CHUNK_SIZE = 1 * MB
+# S3 requires every multipart part but the last to be at least 5 MB
+MULTIPART_PART_SIZE = 8 * MB
+
+MAX_IMAGE_SIZE = 10 * MB
+MAX_VIDEO_SIZE = 50 * MB
+MAX_AUDIO_SIZE = 8 * MB
+MAX_DOC_SIZE = 20 * MB
+
+
+def max_file_size(file_type: str) -> int:
+    if file_type in SUPPORTED_FILE_TYPES_FORM_IMAGE:
+        return MAX_IMAGE_SIZE
+    if file_type in SUPPORTED_FILE_TYPES_FORM_VIDEO:
+        return MAX_VIDEO_SIZE
+    if file_type in SUPPORTED_FILE_TYPES_FORM_AUDIO:
+        return MAX_AUDIO_SIZE
+    return MAX_DOC_SIZE
+
+
+DOWNLOAD_CHUNK_SIZE = 256 * KB
+
+CONTENT_TYPES_BY_EXTENSION = {value: key for key, value in SUPPORTED_FILE_TYPES_FORM_APPLICATION.items()}
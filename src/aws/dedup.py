@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from aws.schemas import FileRead
+from cache import TTLCache
+from config import MEDIA_DEDUP_CACHE_SIZE, MEDIA_DEDUP_CACHE_TTL, MEDIA_KEY_SECRET
+from database import async_session_maker
+from models.models import media_object
+
+logger = logging.getLogger(__name__)
+
+# content hash -> stored object; entries never change, the TTL only bounds memory
+known_objects = TTLCache(MEDIA_DEDUP_CACHE_SIZE, MEDIA_DEDUP_CACHE_TTL)
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+async def content_hash(data: bytes) -> str:
+    # hashlib releases the GIL on large buffers, so a thread keeps big files off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, _sha256, data)
+
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def file_hash(path: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(None, _sha256_file, path)
+
+
+def scoped_hash(digest: str, pipeline: str) -> str:
+    """Dedup key of content processed by another pipeline than chat media, e.g. profile pictures"""
+    return hashlib.sha256(f'{pipeline}:{digest}'.encode()).hexdigest()
+
+
+def _object_id(digest: str) -> str:
+    # the plain digest would let anyone holding a file check whether it was shared
+    return hmac.new(MEDIA_KEY_SECRET.encode(), digest.encode(), hashlib.sha256).hexdigest()
+
+
+def content_key(digest: str, extension: str) -> str:
+    return f'{_object_id(digest)}.{extension}'
+
+
+def variant_key(digest: str, variant: str, extension: str) -> str:
+    return f'{_object_id(digest)}.{variant}.{extension}'
+
+
+async def find_media(digest: str) -> Optional[FileRead]:
+    """Object (and variants) already stored for this content, if any"""
+    media_file = known_objects.get(digest)
+    if media_file is not None:
+        return media_file
+    try:
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(media_object.c.object_key, media_object.c.variants, media_object.c.width,
+                       media_object.c.height, media_object.c.duration)
+                .where(media_object.c.content_hash == digest)
+            )
+            row = result.first()
+    except Exception as e:
+        # a failed lookup only costs a duplicate upload
+        logger.error(f"Error looking up media {digest}: {type(e)} {e}")
+        return None
+    if row is None:
+        return None
+    media_file = FileRead(file_name=row.object_key, variants=row.variants, width=row.width, height=row.height,
+                          duration=row.duration)
+    known_objects.set(digest, media_file)
+    return media_file
+
+
+async def remember_media(digest: str, file_type: str, media_file: FileRead, size: int,
+                         replace: bool = False) -> None:
+    values = dict(file_type=file_type, object_key=media_file.file_name, variants=media_file.variants,
+                  width=media_file.width, height=media_file.height, duration=media_file.duration, size=size)
+    statement = insert(media_object).values(content_hash=digest, **values)
+    if replace:
+        statement = statement.on_conflict_do_update(index_elements=[media_object.c.content_hash], set_=values)
+    else:
+        # concurrent uploads of the same content store the same key, the first row wins
+        statement = statement.on_conflict_do_nothing(index_elements=[media_object.c.content_hash])
+    try:
+        async with async_session_maker() as session:
+            await session.execute(statement)
+            await session.commit()
+    except Exception as e:
+        logger.error(f"Error indexing media {digest}: {type(e)} {e}")
+        return
+    known_objects.set(digest, media_file)
@@ -0,0 +1,91 @@
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+# runs inside worker processes: everything here has to be importable and picklable
+
+MAX_DIMENSIONS = (2048, 1080)
+
+# bounding boxes of the downscaled renditions; "full" is the MAX_DIMENSIONS copy itself
+VARIANT_SIZES = {
+    'thumb': (320, 320),
+    'medium': (1024, 1024),
+}
+WEBP = 'webp'
+
+PIL_FORMATS = {
+    'png': 'PNG',
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'gif': 'GIF',
+    'webp': 'WEBP',
+}
+
+
+class ImageTooSmall(ValueError):
+    pass
+
+
+def _open(data: bytes) -> Image.Image:
+    # Image.open only parses the header, pixels are decoded on demand
+    return Image.open(BytesIO(data))
+
+
+def compress(img: Image.Image, image_format: str, max_dimensions: Tuple[int, int] = MAX_DIMENSIONS) -> bytes:
+    width, height = img.size
+    if width >= max_dimensions[0] or height >= max_dimensions[1]:
+        # for JPEG, let the decoder scale down by a power of two instead of decoding full resolution
+        img.draft(None, max_dimensions)
+        img.thumbnail(max_dimensions)
+    return _encode(img, image_format)
+
+
+def prepare_image(data: bytes, image_format: str, min_side: int, force_compress: bool) -> Optional[bytes]:
+    """Validate and, if needed, compress an image in one round-trip; None means keep the original bytes."""
+    img = _open(data)
+    width, height = img.size
+    if width < min_side or height < min_side:
+        raise ImageTooSmall(f'{width}x{height}')
+    if width > MAX_DIMENSIONS[0] or height > MAX_DIMENSIONS[1] or force_compress:
+        try:
+            return compress(img, image_format)
+        except Exception:
+            # an image that can't be re-encoded is still stored as uploaded
+            return None
+    return None
+
+
+def _encode(img: Image.Image, image_format: str) -> bytes:
+    pil_format = PIL_FORMATS[image_format]
+    if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img_io = BytesIO()
+    img.save(img_io, format=pil_format)
+    return img_io.getvalue()
+
+
+def render_variants(data: bytes, image_format: str, min_side: int, force_compress: bool) -> Dict[str, Any]:
+    """Validate and compress the full image, then render the smaller variants, in one worker round-trip.
+
+    Returns the full image bytes (None to keep the original), its size, and (name, format, width, height, bytes)
+    renditions. Variants the full image already fits in are left out, as are those of animated images.
+    """
+    full = prepare_image(data, image_format, min_side, force_compress)
+    img = _open(full if full is not None else data)
+    result = {'full': full, 'width': img.width, 'height': img.height, 'variants': []}
+    if getattr(img, 'is_animated', False):
+        return result
+    img.load()
+    variants: List[Tuple[str, str, int, int, bytes]] = result['variants']
+    if image_format != WEBP:
+        variants.append(('full', WEBP, img.width, img.height, _encode(img, WEBP)))
+    formats = [image_format] if image_format == WEBP else [image_format, WEBP]
+    for name, box in VARIANT_SIZES.items():
+        if img.width <= box[0] and img.height <= box[1]:
+            continue
+        resized = img.copy()
+        resized.thumbnail(box)
+        for variant_format in formats:
+            variants.append((name, variant_format, resized.width, resized.height, _encode(resized, variant_format)))
+    return result
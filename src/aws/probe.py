@@ -0,0 +1,77 @@
+import asyncio
+import base64
+from io import BytesIO
+from typing import BinaryIO, Union
+
+import av
+import magic
+from PIL import Image
+
+from aws.constants import SNIFF_SIZE, SUPPORTED_FILE_TYPES_FORM_IMAGE, SUPPORTED_FILE_TYPES_FORM_VIDEO, \
+    SUPPORTED_FILE_TYPES_FORM_AUDIO
+from aws.schemas import MediaInfo
+
+
+class MediaMismatch(ValueError):
+    pass
+
+
+def sniff_mime(head: bytes) -> str:
+    return magic.from_buffer(buffer=head[:SNIFF_SIZE], mime=True)
+
+
+def sniff_base64(base64_data: str) -> str:
+    # decode just enough characters for SNIFF_SIZE bytes, the payload itself stays encoded
+    length = (SNIFF_SIZE + 2) // 3 * 4
+    return sniff_mime(base64.b64decode(base64_data[:length]))
+
+
+# names clients announce -> the name libmagic reports for the same format
+MIME_ALIASES = {
+    'image/jpg': 'image/jpeg',
+    'video/mov': 'video/quicktime',
+    'video/avi': 'video/x-msvideo',
+    'audio/x-wav': 'audio/wav',
+    'audio/wave': 'audio/wav',
+    'audio/vnd.wave': 'audio/wav',
+}
+
+
+def check_mime(declared: str, sniffed: str) -> None:
+    """The content has to be of the type the client announced"""
+    if MIME_ALIASES.get(declared, declared) != MIME_ALIASES.get(sniffed, sniffed):
+        raise MediaMismatch(f'File content is {sniffed}, not {declared}.')
+
+
+def _probe(source: Union[str, BinaryIO], file_type: str) -> MediaInfo:
+    info = MediaInfo(mime_type=file_type)
+    if file_type in SUPPORTED_FILE_TYPES_FORM_IMAGE:
+        # parses the header only, no pixel is decoded
+        info.width, info.height = Image.open(source).size
+        return info
+    if file_type not in SUPPORTED_FILE_TYPES_FORM_VIDEO and file_type not in SUPPORTED_FILE_TYPES_FORM_AUDIO:
+        return info
+    # demuxer setup reads the container header and stream parameters; no packet is decoded
+    with av.open(source) as container:
+        stream = container.streams.video[0] if container.streams.video else None
+        if stream is not None:
+            info.width = stream.codec_context.width
+            info.height = stream.codec_context.height
+        else:
+            stream = container.streams.audio[0] if container.streams.audio else None
+        if stream is not None:
+            info.codec = stream.codec_context.name
+        if container.duration:
+            info.duration = container.duration / av.time_base
+        elif stream is not None and stream.duration and stream.time_base:
+            info.duration = float(stream.duration * stream.time_base)
+    if file_type in SUPPORTED_FILE_TYPES_FORM_VIDEO and info.width is None:
+        raise MediaMismatch('The file has no video stream.')
+    return info
+
+
+async def probe(source: Union[str, bytes], file_type: str) -> MediaInfo:
+    """Type, dimensions, duration and codec of a media file, taken from its container header"""
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    return await asyncio.get_running_loop().run_in_executor(None, _probe, source, file_type)
@@ -0,0 +1,19 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header
+
+from auth.base_config import fastapi_users
+from aws.service import download
+
+router = APIRouter()
+
+
+@router.get("/file/{file_name:path}", dependencies=[Depends(fastapi_users.current_user())])
+async def download_file(file_name: str,
+                        range_header: Optional[str] = Header(None, alias="Range"),
+                        if_none_match: Optional[str] = Header(None, alias="If-None-Match")):
+    """
+    Stream a stored file
+    supports Range requests (media seeking) and If-None-Match
+    """
+    return await download(file_name, range_header, if_none_match)
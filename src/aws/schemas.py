@@ -1,5 +1,21 @@
+from typing import Dict, Optional, Union
+
 from pydantic import BaseModel
 
 
 class FileRead(BaseModel):
     file_name: str
+    # variant name -> {"width", "height", <format>: object key}
+    variants: Optional[Dict[str, Dict[str, Union[int, str]]]] = None
+    # of the stored media, for clients to lay out a placeholder before fetching it
+    width: Optional[int] = None
+    height: Optional[int] = None
+    duration: Optional[float] = None
+
+
+class MediaInfo(BaseModel):
+    mime_type: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    duration: Optional[float] = None
+    codec: Optional[str] = None
@@ -1,117 +1,144 @@
+import asyncio
 import base64
-import time
-from io import BytesIO
-from typing import Optional
+import os
+import tempfile
+from typing import Any, Callable, Optional, Union
 from uuid import uuid4
 
-import av
 import magic
-from PIL import Image
 from fastapi import HTTPException, Response, UploadFile, status
+from fastapi.responses import StreamingResponse
 
+from aws import imaging, transcoding
+from aws.dedup import content_hash, content_key, variant_key, file_hash, find_media, remember_media, scoped_hash
 from aws.constants import MB, SUPPORTED_FILE_TYPES_FORM_IMAGE, SUPPORTED_FILE_TYPES_FORM_AUDIO, \
-    SUPPORTED_FILE_TYPES_FORM_VIDEO, SUPPORTED_FILE_TYPES_FORM_APPLICATION
-from aws.schemas import FileRead
-from aws.utils import s3_download, s3_upload, s3_URL
+    SUPPORTED_FILE_TYPES_FORM_VIDEO, SUPPORTED_FILE_TYPES_FORM_APPLICATION, SUPPORTED_FILE_TYPES_FORM_MESSAGE, \
+    SNIFF_SIZE, UPLOAD_CHUNK_SIZE, \
+    CONTENT_TYPES_BY_EXTENSION, MULTIPART_PART_SIZE, max_file_size
+from aws.probe import MediaMismatch, check_mime, probe, sniff_base64
+from aws.schemas import FileRead, MediaInfo
+from aws.storage import StreamingUpload, storage, NotModified, ObjectNotFound, InvalidRange
+from aws.utils import s3_upload, s3_URL
+from aws.workers import image_workers, video_workers
 
-import shotstack_sdk
-from shotstack_sdk.api import edit_api
-from shotstack_sdk.model.clip import Clip
-from shotstack_sdk.model.edit import Edit
-from shotstack_sdk.model.output import Output
-from shotstack_sdk.model.timeline import Timeline
-from shotstack_sdk.model.track import Track
-from shotstack_sdk.model.video_asset import VideoAsset
-import certifi
+from config import TRANSCODE_TMP_DIR
 
-from config import SHOTSTACK_API
 
+def _write_file(path: str, contents: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(contents)
 
-async def compress_video(video_data: bytes, file_type: str, resize_flag: bool) -> FileRead:
-    file_name = f'{uuid4()}.{SUPPORTED_FILE_TYPES_FORM_APPLICATION[file_type]}'
-    await s3_upload(contents=video_data, key=file_name)
 
-    current_video_url_in_backblaze = await get_url(file_name)
+async def _upload_file(path: str, key: str) -> None:
+    loop = asyncio.get_running_loop()
+    with open(path, 'rb') as f:
+        async with StreamingUpload(key) as destination:
+            while chunk := await loop.run_in_executor(None, f.read, MULTIPART_PART_SIZE):
+                await destination.write(chunk)
 
-    configuration = shotstack_sdk.Configuration(host='https://api.shotstack.io/stage')
-    configuration.ssl_ca_cert = certifi.where()
-    configuration.verify_ssl = False
-    configuration.api_key['DeveloperKey'] = SHOTSTACK_API
 
-    with shotstack_sdk.ApiClient(configuration) as api_client:
-        api_instance = edit_api.EditApi(api_client)
+async def _transcode_to_storage(source: str, resize_flag: bool, file_name: str) -> FileRead:
+    with tempfile.TemporaryDirectory(prefix='transcode-', dir=TRANSCODE_TMP_DIR) as workdir:
+        target = os.path.join(workdir, 'target.mp4')
+        try:
+            output = await video_workers.run(transcoding.transcode, source, target, 'hd' if resize_flag else 'sd')
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'Video could not be processed: {str(e)}'
+            )
+        await _upload_file(target, file_name)
+    return FileRead(file_name=file_name, **output)
 
-        api_response = api_instance.probe(current_video_url_in_backblaze)
 
-        streams = api_response['response']['metadata']['streams']
+async def compress_video(video_data: bytes, file_type: str, resize_flag: bool,
+                         file_name: Optional[str] = None) -> FileRead:
+    file_name = file_name or f'{uuid4()}.mp4'
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory(prefix='transcode-', dir=TRANSCODE_TMP_DIR) as workdir:
+        source = os.path.join(workdir, f'source.{SUPPORTED_FILE_TYPES_FORM_APPLICATION[file_type]}')
+        await loop.run_in_executor(None, _write_file, source, video_data)
+        return await _transcode_to_storage(source, resize_flag, file_name)
 
-        duration = None
-        for stream in streams:
-            if stream['codec_type'] == "video":
-                duration = stream['duration']
 
-        video_asset = VideoAsset(
-            src=current_video_url_in_backblaze
+async def _run_image_job(func: Callable, contents: bytes, file_type: str, min_side: int,
+                         too_small_detail: str) -> Any:
+    # decoding, validation and compression all happen in a worker process
+    size = len(contents)
+    try:
+        return await image_workers.run(func, contents, SUPPORTED_FILE_TYPES_FORM_IMAGE[file_type],
+                                       min_side, 1 * MB <= size <= 10 * MB)
+    except imaging.ImageTooSmall:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=too_small_detail
         )
-
-        video_clip = Clip(
-            asset=video_asset,
-            start=0.0,
-            length=float(duration)
+    except HTTPException:
+        raise
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Image could not be read.'
         )
 
-        track = Track(clips=[video_clip])
 
-        timeline = Timeline(
-            background="#000000",
-            tracks=[track]
+async def _prepare_image(contents: bytes, file_type: str, min_side: int, too_small_detail: str) -> bytes:
+    prepared = await _run_image_job(imaging.prepare_image, contents, file_type, min_side, too_small_detail)
+    return contents if prepared is None else prepared
+
+
+async def _store_image(contents: bytes, file_type: str, digest: str) -> FileRead:
+    """
+    Store the full image and its thumb/medium/full renditions in the original format and WebP
+    """
+    rendered = await _run_image_job(imaging.render_variants, contents, file_type, 100,
+                                    'Image size is too small. More than 100x100 is required.')
+    extension = SUPPORTED_FILE_TYPES_FORM_IMAGE[file_type]
+    file_name = content_key(digest, extension)
+    full = {'width': rendered['width'], 'height': rendered['height'], extension: file_name}
+    uploads = [s3_upload(contents=rendered['full'] or contents, key=file_name)]
+    variants = {'full': full}
+    for name, variant_format, width, height, data in rendered['variants']:
+        key = variant_key(digest, name, variant_format)
+        variants.setdefault(name, {'width': width, 'height': height})[variant_format] = key
+        uploads.append(s3_upload(contents=data, key=key))
+    await asyncio.gather(*uploads)
+    # a variant the full image already fits in is the full image
+    for name in imaging.VARIANT_SIZES:
+        variants.setdefault(name, full)
+    return FileRead(file_name=file_name, variants=variants, width=rendered['width'], height=rendered['height'])
+
+
+def _check_message_type(file_type: str) -> None:
+    if file_type not in SUPPORTED_FILE_TYPES_FORM_MESSAGE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'Unsupported file type: {file_type}. '
+                   f'Supported types are {list(SUPPORTED_FILE_TYPES_FORM_MESSAGE)}'
         )
-        if resize_flag:
-            output = Output(format="mp4", resolution="hd")
-        else:
-            output = Output(format="mp4", resolution="sd")
 
-        edit = Edit(timeline=timeline, output=output)
 
-        url = None
-        try:
-            api_id = api_instance.post_render(edit)
-            id = api_id['response']['id']
-
-            while True:
-                api_response = api_instance.get_render(id, data=False, merged=True)
-                status = api_response['response']['status']
-                if status == "done":
-                    url = api_response['response']['url']
-                    break
-                elif status == 'failed':
-                    print(">> Something went wrong, rendering has terminated and will not continue.")
-                    break
-                print('Status: ' + status.upper() + '\n')
-                time.sleep(1)
+def _reusable(known: Optional[FileRead], file_type: str) -> bool:
+    # an image entry without renditions was stored before they existed, it is processed again and replaced
+    return known is not None and (file_type not in SUPPORTED_FILE_TYPES_FORM_IMAGE or bool(known.variants))
 
-        except Exception as e:
-            print(f"Unable to resolve API call: {e}")
 
-    return FileRead(file_name=str(url))
+def _too_large(file_type: str, max_size: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f'{file_type} file size exceeds the maximum allowed one of {max_size / MB} MB. Try another one.'
+    )
 
 
-async def compress_image(file_type: str, image_data: bytes) -> bytes:
+async def _probe(source: Union[str, bytes], file_type: str) -> MediaInfo:
     try:
-        img = Image.open(BytesIO(image_data))
-        width, height = img.size
-        img_io = BytesIO()
-
-        if width >= 2048 or height >= 1080:
-            img.thumbnail((2048, 1080))
-
-        img.save(img_io, format=SUPPORTED_FILE_TYPES_FORM_IMAGE[file_type])
-
-        return img_io.getvalue()
-    except Exception as e:
+        return await probe(source, file_type)
+    except Exception:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f'Error compressing image: {str(e)}'
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'{file_type} file could not be read.'
         )
 
 
@@ -122,27 +149,52 @@ async def upload_from_base64(base64_data: str, file_type: str) -> Optional[FileR
             detail='Base64 data not found!'
         )
 
+    _check_message_type(file_type)
+
+    # the decoded size is known from the base64 length, reject before decoding or probing anything
+    decoded_size = len(base64_data) * 3 // 4 - base64_data[-2:].count('=')
+    if decoded_size > max_file_size(file_type):
+        raise _too_large(file_type, max_file_size(file_type))
+    # and the type from the first few KB
+    try:
+        check_mime(file_type, sniff_base64(base64_data))
+    except (MediaMismatch, ValueError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e) if isinstance(e, MediaMismatch) else 'Invalid base64 data.'
+        )
+
     contents = base64.b64decode(base64_data)
+    # identical content (a forwarded file) reuses the object stored the first time, unprocessed
+    digest = await content_hash(contents)
+    known = await find_media(digest)
+    if _reusable(known, file_type):
+        return known
+    media_file = await _store_contents(contents, file_type, digest)
+    await remember_media(digest, file_type, media_file, len(contents), replace=known is not None)
+    return media_file
+
+
+async def _store_contents(contents: bytes, file_type: str, digest: str) -> FileRead:
     size = len(contents)
 
+    info = None
+
     if file_type in SUPPORTED_FILE_TYPES_FORM_AUDIO:
         max_size = 8 * MB
         error_message = f'Audio file size exceeds the maximum allowed one of {max_size / MB} MB. Try another one.'
+        info = await _probe(contents, file_type)
 
     elif file_type in SUPPORTED_FILE_TYPES_FORM_VIDEO:
         max_size = 50 * MB
         error_message = f'Video file size exceeds the maximum allowed one of {max_size / MB} MB. Try another one.'
 
-        container = av.open(BytesIO(contents))
-        video_stream_info = container.streams.video[0]
-        width = video_stream_info.width
-        height = video_stream_info.height
-
-        resize_flag = width >= 1920 or height >= 1080
+        info = await _probe(contents, file_type)
+        resize_flag = info.width >= 1920 or info.height >= 1080
         size_flag = size >= 8 * MB
 
         if resize_flag or size_flag:
-            return await compress_video(contents, file_type, resize_flag)
+            return await compress_video(contents, file_type, resize_flag, content_key(digest, 'mp4'))
 
         if size > max_size:
             raise HTTPException(
@@ -153,16 +205,12 @@ async def upload_from_base64(base64_data: str, file_type: str) -> Optional[FileR
     elif file_type in SUPPORTED_FILE_TYPES_FORM_IMAGE:
         max_size = 10 * MB
         error_message = 'Image file size should not exceed 10 MB.'
-        img = Image.open(BytesIO(contents))
-        width, height = img.size
-
-        if width < 100 or height < 100:
+        if size > max_size:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail='Image size is too small. More than 100x100 is required.'
+                detail=error_message
             )
-        if (width > 2048 or height > 1080) or (1 * MB <= size <= 10 * MB):
-            contents = await compress_image(file_type, contents)
+        return await _store_image(contents, file_type, digest)
 
     else:
         raise HTTPException(
@@ -179,9 +227,75 @@ async def upload_from_base64(base64_data: str, file_type: str) -> Optional[FileR
             detail=error_message
         )
 
-    file_name = f'{uuid4()}.{SUPPORTED_FILE_TYPES_FORM_APPLICATION[file_type]}'
+    file_name = content_key(digest, SUPPORTED_FILE_TYPES_FORM_APPLICATION[file_type])
     await s3_upload(contents=contents, key=file_name)
-    return FileRead(file_name=file_name)
+    return _with_info(FileRead(file_name=file_name), info)
+
+
+def _with_info(media_file: FileRead, info: Optional[MediaInfo]) -> FileRead:
+    if info is not None:
+        media_file.width, media_file.height, media_file.duration = info.width, info.height, info.duration
+    return media_file
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def upload_from_path(path: str, file_type: str, digest: Optional[str] = None) -> FileRead:
+    """
+    Same checks and processing as upload_from_base64 for a file already spooled to disk
+    """
+    _check_message_type(file_type)
+    loop = asyncio.get_running_loop()
+    size = await loop.run_in_executor(None, os.path.getsize, path)
+    max_size = max_file_size(file_type)
+    if size > max_size:
+        raise _too_large(file_type, max_size)
+
+    digest = digest or await file_hash(path)
+    known = await find_media(digest)
+    if _reusable(known, file_type):
+        return known
+    media_file = await _store_file(path, file_type, digest)
+    await remember_media(digest, file_type, media_file, size, replace=known is not None)
+    return media_file
+
+
+async def _store_file(path: str, file_type: str, digest: str) -> FileRead:
+    loop = asyncio.get_running_loop()
+    size = await loop.run_in_executor(None, os.path.getsize, path)
+    file_name = content_key(digest, SUPPORTED_FILE_TYPES_FORM_APPLICATION[file_type])
+
+    info = None
+
+    if file_type in SUPPORTED_FILE_TYPES_FORM_VIDEO:
+        info = await _probe(path, file_type)
+        resize_flag = info.width >= 1920 or info.height >= 1080
+        if resize_flag or size >= 8 * MB:
+            # the transcoder reads the spooled file directly, it is never loaded into memory here
+            return await _transcode_to_storage(path, resize_flag, content_key(digest, 'mp4'))
+
+    elif file_type in SUPPORTED_FILE_TYPES_FORM_IMAGE:
+        contents = await loop.run_in_executor(None, _read_file, path)
+        return await _store_image(contents, file_type, digest)
+
+    elif file_type in SUPPORTED_FILE_TYPES_FORM_AUDIO:
+        info = await _probe(path, file_type)
+
+    await _upload_file(path, file_name)
+    return _with_info(FileRead(file_name=file_name), info)
+
+
+async def _read_limited(file: UploadFile, head: bytes, file_type: str, max_size: int) -> bytes:
+    # the limit is enforced while reading, an oversized body is never fully buffered
+    contents = bytearray(head)
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        contents += chunk
+        if len(contents) > max_size:
+            raise _too_large(file_type, max_size)
+    return bytes(contents)
 
 
 async def upload(file: Optional[UploadFile] = None) -> Optional[FileRead]:
@@ -191,42 +305,35 @@ async def upload(file: Optional[UploadFile] = None) -> Optional[FileRead]:
             detail='File not found!'
         )
 
-    contents = await file.read()
-    size = len(contents)
-
-    file_type = magic.from_buffer(buffer=contents, mime=True)
-    file_name = ''
+    head = await file.read(SNIFF_SIZE)
+    file_type = magic.from_buffer(buffer=head, mime=True)
 
-    if file_type in SUPPORTED_FILE_TYPES_FORM_IMAGE:
-        try:
-            img = Image.open(BytesIO(contents))
-            width, height = img.size
-
-            if width <= 10 or height <= 10:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail='Image size is too small to be previewed. More than 10x10 is required.'
-                )
-            if (width > 2048 or height > 1080) or (1 * MB <= size <= 10 * MB):
-                contents = await compress_image(file_type, contents)
-            if size > 10 * MB:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail='Image file size should not exceed 10 MB. '
-                )
-            file_name = f'{uuid4()}.{SUPPORTED_FILE_TYPES_FORM_APPLICATION[file_type]}'
-        except Exception:
-            print("Compression failed.")
-            pass
-    else:
+    if file_type not in SUPPORTED_FILE_TYPES_FORM_IMAGE:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f'Unsupported file type: {file_type}. '
-                   f'Supported types are {SUPPORTED_FILE_TYPES_FORM_AUDIO + SUPPORTED_FILE_TYPES_FORM_VIDEO + SUPPORTED_FILE_TYPES_FORM_IMAGE}'
+                   f'Supported types are {list(SUPPORTED_FILE_TYPES_FORM_IMAGE)}'
         )
 
-    await s3_upload(contents=contents, key=file_name)
-    return FileRead(file_name=file_name)
+    max_size = max_file_size(file_type)
+    declared_size = getattr(file, 'size', None)
+    if declared_size is not None and declared_size > max_size:
+        raise _too_large(file_type, max_size)
+
+    contents = await _read_limited(file, head, file_type, max_size)
+    # profile pictures skip the renditions and size checks of chat images, so they are deduplicated apart
+    digest = scoped_hash(await content_hash(contents), 'avatar')
+    known = await find_media(digest)
+    if known is not None:
+        return FileRead(file_name=known.file_name)
+    size = len(contents)
+    contents = await _prepare_image(contents, file_type, 11,
+                                    'Image size is too small to be previewed. More than 10x10 is required.')
+
+    media_file = FileRead(file_name=content_key(digest, SUPPORTED_FILE_TYPES_FORM_APPLICATION[file_type]))
+    await s3_upload(contents=contents, key=media_file.file_name)
+    await remember_media(digest, file_type, media_file, size)
+    return media_file
 
 
 async def get_url(file_name: Optional[str] = None):
@@ -240,18 +347,40 @@ async def get_url(file_name: Optional[str] = None):
     return contents
 
 
-async def download(file_name: Optional[str] = None) -> Response:
+async def download(file_name: Optional[str] = None, range_header: Optional[str] = None,
+                   if_none_match: Optional[str] = None) -> Response:
     if not file_name:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail='No file name provided.'
         )
 
-    contents = await s3_download(key=file_name)
-    return Response(
-        content=contents,
-        headers={
-            'Content-Disposition': f'attachment;filename={file_name}',
-            'Content-Type': 'application/octet-stream',
-        }
+    try:
+        stream = await storage.open_stream(file_name, range_header, if_none_match)
+    except NotModified as e:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': e.etag or if_none_match})
+    except ObjectNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='File not found.')
+    except InvalidRange as e:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail='Requested range not satisfiable.',
+            headers={'Content-Range': f'bytes */{e.size}'} if e.size is not None else None
+        )
+
+    extension = file_name.rsplit('.', 1)[-1].lower()
+    headers = {
+        'Content-Disposition': f'attachment;filename={file_name.rsplit("/", 1)[-1]}',
+        'Content-Length': str(stream.length),
+        'Accept-Ranges': 'bytes',
+        'ETag': stream.etag,
+        'Cache-Control': 'private, max-age=31536000, immutable',
+    }
+    if stream.content_range is not None:
+        headers['Content-Range'] = stream.content_range
+    return StreamingResponse(
+        stream.chunks,
+        status_code=status.HTTP_206_PARTIAL_CONTENT if stream.content_range else status.HTTP_200_OK,
+        media_type=CONTENT_TYPES_BY_EXTENSION.get(extension, 'application/octet-stream'),
+        headers=headers,
     )
@@ -0,0 +1,304 @@
+import asyncio
+import re
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+from uuid import uuid4
+
+from aws.client import client
+from botocore.exceptions import ClientError
+
+from aws.constants import MULTIPART_PART_SIZE, DOWNLOAD_CHUNK_SIZE
+from config import AWS_BUCKET, STORAGE_BACKEND, LOCAL_STORAGE_PATH, LOCAL_STORAGE_URL, S3_MAX_WORKERS, \
+    S3_URL_EXPIRES_IN
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class NotModified(Exception):
+    def __init__(self, etag: str):
+        self.etag = etag
+
+
+class InvalidRange(Exception):
+    def __init__(self, size: Optional[int] = None):
+        self.size = size
+
+
+class ObjectStream:
+    """A (possibly partial) object body read chunk by chunk."""
+
+    def __init__(self, chunks: AsyncIterator[bytes], length: int, etag: str,
+                 content_range: Optional[str] = None):
+        self.chunks = chunks
+        self.length = length
+        self.etag = etag
+        # set only for a 206 response
+        self.content_range = content_range
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) of a single "bytes=" range, None to serve the whole object."""
+    if not range_header:
+        return None
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if match is None:
+        # multiple or unknown ranges may be ignored and answered with the full body
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        raise InvalidRange(size)
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise InvalidRange(size)
+    return start, end
+
+
+class Storage:
+    """Object storage whose blocking I/O runs on a bounded thread pool, off the event loop."""
+
+    def __init__(self, max_workers: int = S3_MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='storage')
+
+    async def _run(self, func: Callable, *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def put(self, key: str, contents: bytes) -> None:
+        raise NotImplementedError
+
+    def presign_url(self, key: str, expires_in: int = S3_URL_EXPIRES_IN) -> str:
+        raise NotImplementedError
+
+    async def open_stream(self, key: str, range_header: Optional[str] = None,
+                          if_none_match: Optional[str] = None) -> ObjectStream:
+        raise NotImplementedError
+
+    async def create_multipart(self, key: str) -> str:
+        raise NotImplementedError
+
+    async def upload_part(self, key: str, upload_id: str, part_number: int, contents: bytes) -> str:
+        raise NotImplementedError
+
+    async def complete_multipart(self, key: str, upload_id: str, parts: List[Tuple[int, str]]) -> None:
+        raise NotImplementedError
+
+    async def abort_multipart(self, key: str, upload_id: str) -> None:
+        raise NotImplementedError
+
+
+class S3Storage(Storage):
+    def __init__(self, bucket: str = AWS_BUCKET, max_workers: int = S3_MAX_WORKERS):
+        super().__init__(max_workers)
+        self.client = client
+        self.bucket = bucket
+
+    async def put(self, key: str, contents: bytes) -> None:
+        await self._run(self.client.put_object, Key=key, Body=contents, Bucket=self.bucket)
+
+    def presign_url(self, key: str, expires_in: int = S3_URL_EXPIRES_IN) -> str:
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': key},
+                                                  ExpiresIn=expires_in)
+
+    async def open_stream(self, key: str, range_header: Optional[str] = None,
+                          if_none_match: Optional[str] = None) -> ObjectStream:
+        params = {'Bucket': self.bucket, 'Key': key}
+        if range_header:
+            params['Range'] = range_header
+        if if_none_match:
+            params['IfNoneMatch'] = if_none_match
+        try:
+            response = await self._run(self.client.get_object, **params)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if status == 304 or code == '304':
+                raise NotModified(if_none_match)
+            if code in ('NoSuchKey', '404'):
+                raise ObjectNotFound(key)
+            if code == 'InvalidRange':
+                raise InvalidRange()
+            raise
+        body = response['Body']
+
+        async def chunks():
+            try:
+                while chunk := await self._run(body.read, DOWNLOAD_CHUNK_SIZE):
+                    yield chunk
+            finally:
+                body.close()
+
+        return ObjectStream(chunks(), response['ContentLength'], response['ETag'], response.get('ContentRange'))
+
+    async def create_multipart(self, key: str) -> str:
+        response = await self._run(self.client.create_multipart_upload, Bucket=self.bucket, Key=key)
+        return response['UploadId']
+
+    async def upload_part(self, key: str, upload_id: str, part_number: int, contents: bytes) -> str:
+        response = await self._run(self.client.upload_part, Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                   PartNumber=part_number, Body=contents)
+        return response['ETag']
+
+    async def complete_multipart(self, key: str, upload_id: str, parts: List[Tuple[int, str]]) -> None:
+        await self._run(self.client.complete_multipart_upload, Bucket=self.bucket, Key=key, UploadId=upload_id,
+                        MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etag} for n, etag in parts]})
+
+    async def abort_multipart(self, key: str, upload_id: str) -> None:
+        await self._run(self.client.abort_multipart_upload, Bucket=self.bucket, Key=key, UploadId=upload_id)
+
+
+class LocalStorage(Storage):
+    """Filesystem stand-in for S3, for tests and benchmarks."""
+
+    def __init__(self, root: str = LOCAL_STORAGE_PATH, base_url: str = LOCAL_STORAGE_URL,
+                 max_workers: int = S3_MAX_WORKERS):
+        super().__init__(max_workers)
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"Invalid key: {key}")
+        return path
+
+    async def put(self, key: str, contents: bytes) -> None:
+        def write():
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(contents)
+        await self._run(write)
+
+    def presign_url(self, key: str, expires_in: int = S3_URL_EXPIRES_IN) -> str:
+        return f'{self.base_url}/{key}'
+
+    async def open_stream(self, key: str, range_header: Optional[str] = None,
+                          if_none_match: Optional[str] = None) -> ObjectStream:
+        path = self._path(key)
+        try:
+            stat = await self._run(os.stat, path)
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        if if_none_match and etag in (tag.strip() for tag in if_none_match.split(',')):
+            raise NotModified(etag)
+        byte_range = parse_range(range_header, stat.st_size)
+        start, end = byte_range if byte_range is not None else (0, stat.st_size - 1)
+        length = end - start + 1
+
+        async def chunks():
+            f = await self._run(open, path, 'rb')
+            try:
+                await self._run(f.seek, start)
+                remaining = length
+                while remaining > 0:
+                    chunk = await self._run(f.read, min(DOWNLOAD_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            finally:
+                f.close()
+
+        content_range = f'bytes {start}-{end}/{stat.st_size}' if byte_range is not None else None
+        return ObjectStream(chunks(), length, etag, content_range)
+
+    def _part_path(self, upload_id: str, part_number: int) -> str:
+        return self._path(os.path.join('.multipart', upload_id, str(part_number)))
+
+    async def create_multipart(self, key: str) -> str:
+        upload_id = uuid4().hex
+        await self._run(os.makedirs, os.path.dirname(self._part_path(upload_id, 1)), exist_ok=True)
+        return upload_id
+
+    async def upload_part(self, key: str, upload_id: str, part_number: int, contents: bytes) -> str:
+        def write():
+            with open(self._part_path(upload_id, part_number), 'wb') as f:
+                f.write(contents)
+        await self._run(write)
+        return str(part_number)
+
+    async def complete_multipart(self, key: str, upload_id: str, parts: List[Tuple[int, str]]) -> None:
+        def assemble():
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as out:
+                for part_number, _ in sorted(parts):
+                    with open(self._part_path(upload_id, part_number), 'rb') as part:
+                        shutil.copyfileobj(part, out)
+        await self._run(assemble)
+        await self.abort_multipart(key, upload_id)
+
+    async def abort_multipart(self, key: str, upload_id: str) -> None:
+        await self._run(shutil.rmtree, os.path.dirname(self._part_path(upload_id, 1)), ignore_errors=True)
+
+
+class StreamingUpload:
+    """Writes an object piece by piece, holding at most one part in memory.
+
+    Objects smaller than one part go out as a single PUT; larger ones become a multipart upload.
+    """
+
+    def __init__(self, key: str, part_size: int = MULTIPART_PART_SIZE, backend: Optional[Storage] = None):
+        self.key = key
+        self.part_size = part_size
+        self.storage = backend if backend is not None else storage
+        self.buffer = bytearray()
+        self.upload_id: Optional[str] = None
+        self.parts: List[Tuple[int, str]] = []
+        self.size = 0
+
+    async def write(self, data: bytes) -> None:
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            await self._flush_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    async def _flush_part(self, contents: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = await self.storage.create_multipart(self.key)
+        part_number = len(self.parts) + 1
+        etag = await self.storage.upload_part(self.key, self.upload_id, part_number, contents)
+        self.parts.append((part_number, etag))
+
+    async def close(self) -> None:
+        if self.upload_id is None:
+            await self.storage.put(self.key, bytes(self.buffer))
+        else:
+            if self.buffer:
+                await self._flush_part(bytes(self.buffer))
+            await self.storage.complete_multipart(self.key, self.upload_id, self.parts)
+        self.buffer = bytearray()
+
+    async def abort(self) -> None:
+        if self.upload_id is not None:
+            await self.storage.abort_multipart(self.key, self.upload_id)
+        self.buffer = bytearray()
+
+    async def __aenter__(self) -> 'StreamingUpload':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.abort()
+
+
+def create_storage(kind: str = STORAGE_BACKEND) -> Storage:
+    if kind == 's3':
+        return S3Storage()
+    if kind == 'local':
+        return LocalStorage()
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+
+storage = create_storage()
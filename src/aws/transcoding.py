@@ -0,0 +1,61 @@
+from typing import Dict, Tuple
+
+import av
+
+# runs inside worker processes: everything here has to be importable and picklable
+
+# the output sizes of the former hosted renderer, so clients see the same videos
+PRESETS = {
+    'hd': (1280, 720),
+    'sd': (1024, 576),
+}
+
+VIDEO_CODEC = 'libx264'
+AUDIO_CODEC = 'aac'
+AUDIO_RATE = 44100
+DEFAULT_FRAME_RATE = 25
+
+
+def _fit(width: int, height: int, box: Tuple[int, int]) -> Tuple[int, int]:
+    # keep the aspect ratio, never upscale, and keep both sides even as yuv420p requires
+    scale = min(box[0] / width, box[1] / height, 1)
+    return max(int(width * scale) // 2 * 2, 2), max(int(height * scale) // 2 * 2, 2)
+
+
+def transcode(source_path: str, target_path: str, preset: str) -> Dict[str, float]:
+    """Re-encode a video into an H.264/AAC mp4 that fits the preset."""
+    with av.open(source_path) as source, \
+            av.open(target_path, 'w', format='mp4', options={'movflags': '+faststart'}) as target:
+        in_video = source.streams.video[0]
+        in_audio = source.streams.audio[0] if source.streams.audio else None
+        in_video.thread_type = 'AUTO'
+
+        width, height = _fit(in_video.codec_context.width, in_video.codec_context.height, PRESETS[preset])
+        out_video = target.add_stream(VIDEO_CODEC, rate=in_video.average_rate or DEFAULT_FRAME_RATE)
+        out_video.width = width
+        out_video.height = height
+        out_video.pix_fmt = 'yuv420p'
+        out_video.options = {'preset': 'veryfast', 'crf': '23'}
+
+        out_audio = None
+        if in_audio is not None:
+            out_audio = target.add_stream(AUDIO_CODEC, rate=AUDIO_RATE)
+
+        streams = [in_video] + ([in_audio] if in_audio is not None else [])
+        for packet in source.demux(*streams):
+            if packet.stream.type == 'video':
+                for frame in packet.decode():
+                    frame = frame.reformat(width=width, height=height, format='yuv420p')
+                    frame.pts = None
+                    target.mux(out_video.encode(frame))
+            elif out_audio is not None:
+                for frame in packet.decode():
+                    frame.pts = None
+                    target.mux(out_audio.encode(frame))
+
+        target.mux(out_video.encode(None))
+        if out_audio is not None:
+            target.mux(out_audio.encode(None))
+
+        duration = float(source.duration / av.time_base) if source.duration else 0.0
+    return {'width': width, 'height': height, 'duration': duration}
@@ -1,10 +1,12 @@
 import logging
-from typing import Optional
+from typing import Dict, Iterable, List, Optional
 
-from botocore.exceptions import ClientError
+from aws.storage import storage
+from cache import TTLCache
+from config import S3_URL_EXPIRES_IN, PRESIGNED_URL_CACHE_SIZE, PRESIGNED_URL_REFRESH_MARGIN
 
-from aws.client import client
-from config import AWS_BUCKET
+# object key -> presigned URL, dropped before the signature runs out
+presigned_urls = TTLCache(PRESIGNED_URL_CACHE_SIZE, max(S3_URL_EXPIRES_IN - PRESIGNED_URL_REFRESH_MARGIN, 0))
 
 
 async def s3_upload(contents: bytes, key: str) -> None:
@@ -13,25 +15,49 @@ async def s3_upload(contents: bytes, key: str) -> None:
             raise ValueError("Invalid 'key' length: 0")
 
         logging.info(f'Uploading {key} to S3...')
-        client.put_object(Key=key, Body=contents, Bucket=AWS_BUCKET)
+        await storage.put(key, contents)
         logging.info(f'{key} successfully uploaded to S3')
     except Exception as e:
         logging.error(f'Error uploading {key} to S3: {str(e)}')
+        # the key is about to be referenced (and deduplicated against), it must not point at nothing
+        raise
+
+
+def media_url(value: Optional[str]) -> Optional[str]:
+    """URL for a stored object key; values that already are URLs (legacy rows) pass through."""
+    if not value or value.startswith(('http://', 'https://')):
+        return value
+    url = presigned_urls.get(value)
+    if url is None:
+        url = storage.presign_url(value)
+        presigned_urls.set(value, url)
+    return url
+
+
+def media_urls(values: Iterable[Optional[str]]) -> Dict[str, str]:
+    return {value: media_url(value) for value in set(values) if value}
+
+
+def variant_keys(variants: Optional[dict]) -> List[str]:
+    return [value for variant in (variants or {}).values()
+            for name, value in variant.items() if name not in ('width', 'height')]
+
+
+def signed_variants(variants: Optional[dict], urls: Dict[str, str]) -> Optional[dict]:
+    """The stored variant record with every object key replaced by its URL"""
+    if not variants:
+        return None
+    return {
+        variant_name: {name: value if name in ('width', 'height') else urls.get(value, value)
+                       for name, value in variant.items()}
+        for variant_name, variant in variants.items()
+    }
 
 
 async def s3_URL(key: str) -> Optional[str]:
     try:
-        url = client.generate_presigned_url('get_object', Params={'Bucket': AWS_BUCKET, 'Key': key})
-        return url
-    except ClientError as e:
+        return media_url(key)
+    except Exception as e:
         print(f"Error generating presigned URL: {str(e)}")
         return None
 
-
-async def s3_download(key: str) -> bytes:
-    logging.info(f'Downloading {key} from s3...')
-    try:
-        response = client.get_object(Bucket=AWS_BUCKET, Key=key)
-        return response['Body'].read()
-    except ClientError as err:
-        logging.error(str(err))
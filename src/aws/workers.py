@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import HTTPException, status
+
+from config import IMAGE_WORKERS, IMAGE_QUEUE_LIMIT, IMAGE_JOB_TIMEOUT, VIDEO_WORKERS, VIDEO_QUEUE_LIMIT, \
+    VIDEO_JOB_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """Bounded process pool for CPU-heavy media work, so it never runs on the event loop thread."""
+
+    def __init__(self, name: str, max_workers: int, max_pending: int, timeout: float):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor: Optional[ProcessPoolExecutor] = None
+        # one slot per worker process, held until the process is actually done with the job
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.pending = 0
+        self.running = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # spawn: forking a process that runs an event loop and boto3 threads is not safe
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_workers)
+        return self.slots
+
+    def _release(self, future: asyncio.Future) -> None:
+        self.running -= 1
+        self.pending -= 1
+        self.slots.release()
+        if not future.cancelled():
+            # consumed here too, a timed out job's error has nobody else waiting for it
+            future.exception()
+
+    async def run(self, func: Callable, *args) -> Any:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='The server is busy processing other media. Try again later.'
+            )
+        self.pending += 1
+        try:
+            await self._get_slots().acquire()
+        except BaseException:
+            self.pending -= 1
+            raise
+        self.running += 1
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        except BaseException:
+            self.running -= 1
+            self.pending -= 1
+            self.slots.release()
+            raise
+        future.add_done_callback(self._release)
+        try:
+            # the timeout starts once a worker has the job; shielded so a timeout doesn't free its slot early
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            # the worker process can't be interrupted; it finishes the job and its result is dropped
+            self.timed_out += 1
+            logger.error(f'{self.name} job {func.__name__} timed out after {self.timeout}s')
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail='Media processing took too long.'
+            )
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'workers': self.max_workers,
+            'pending': self.pending,
+            'running': self.running,
+            'max_pending': self.max_pending,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+        }
+
+
+image_workers = WorkerPool('image', IMAGE_WORKERS, IMAGE_QUEUE_LIMIT, IMAGE_JOB_TIMEOUT)
+video_workers = WorkerPool('video', VIDEO_WORKERS, VIDEO_QUEUE_LIMIT, VIDEO_JOB_TIMEOUT)
@@ -17,4 +17,97 @@ AWS_BUCKET = os.environ.get("AWS_BUCKET")
 
 SECRET_AUTH = os.environ.get("SECRET_AUTH")
 
-SHOTSTACK_API = os.environ.get("SHOTSTACK_API")
\ No newline at end of file
+
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", 256))
+WS_SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", 10))
+# disconnect | drop_oldest | drop_backlog; the last two silently lose messages
+WS_OVERFLOW_POLICY = os.environ.get("WS_OVERFLOW_POLICY", "disconnect")
+
+# memory | unix | postgres
+BACKPLANE = os.environ.get("BACKPLANE", "memory")
+BACKPLANE_CHANNEL = os.environ.get("BACKPLANE_CHANNEL", "chat_backplane")
+BACKPLANE_SOCKET_DIR = os.environ.get("BACKPLANE_SOCKET_DIR", "/tmp/chat-backplane")
+
+MESSAGE_BATCH_SIZE = int(os.environ.get("MESSAGE_BATCH_SIZE", 500))
+MESSAGE_FLUSH_INTERVAL = float(os.environ.get("MESSAGE_FLUSH_INTERVAL", 0.05))
+MESSAGE_QUEUE_SIZE = int(os.environ.get("MESSAGE_QUEUE_SIZE", 10000))
+MESSAGE_FLUSH_RETRIES = int(os.environ.get("MESSAGE_FLUSH_RETRIES", 5))
+MESSAGE_ID_BLOCK_SIZE = int(os.environ.get("MESSAGE_ID_BLOCK_SIZE", 100))
+
+IDENTITY_CACHE_SIZE = int(os.environ.get("IDENTITY_CACHE_SIZE", 100000))
+IDENTITY_CACHE_TTL = float(os.environ.get("IDENTITY_CACHE_TTL", 300))
+
+MESSAGE_PAGE_SIZE = int(os.environ.get("MESSAGE_PAGE_SIZE", 50))
+MESSAGE_PAGE_MAX_SIZE = int(os.environ.get("MESSAGE_PAGE_MAX_SIZE", 200))
+
+ROOM_PAGE_SIZE = int(os.environ.get("ROOM_PAGE_SIZE", 10))
+ROOM_PAGE_MAX_SIZE = int(os.environ.get("ROOM_PAGE_MAX_SIZE", 100))
+# what a joining socket receives; older history is paged over REST
+ROOM_SNAPSHOT_MESSAGES = int(os.environ.get("ROOM_SNAPSHOT_MESSAGES", 50))
+ROOM_SNAPSHOT_MEMBERS = int(os.environ.get("ROOM_SNAPSHOT_MEMBERS", 50))
+
+# in-memory tail of the newest messages per room
+RECENT_MESSAGES_PER_ROOM = int(os.environ.get("RECENT_MESSAGES_PER_ROOM", 100))
+RECENT_MESSAGES_MAX_TOTAL = int(os.environ.get("RECENT_MESSAGES_MAX_TOTAL", 200000))
+# how long a room written to by another worker is read from the database instead
+RECENT_MESSAGES_SETTLE_TIME = float(os.environ.get("RECENT_MESSAGES_SETTLE_TIME", 5))
+
+# how often room and membership is_active flags are written from the in-memory presence
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get("PRESENCE_FLUSH_INTERVAL", 5))
+# workers send their whole presence this often and are forgotten when silent for PRESENCE_PEER_TTL
+PRESENCE_SYNC_INTERVAL = float(os.environ.get("PRESENCE_SYNC_INTERVAL", 30))
+PRESENCE_PEER_TTL = float(os.environ.get("PRESENCE_PEER_TTL", 90))
+
+AUTOCOMPLETE_MAX_SIZE = int(os.environ.get("AUTOCOMPLETE_MAX_SIZE", 50))
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 20))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 100))
+
+# s3 | local
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "s3")
+LOCAL_STORAGE_PATH = os.environ.get("LOCAL_STORAGE_PATH", "/tmp/chat-media")
+LOCAL_STORAGE_URL = os.environ.get("LOCAL_STORAGE_URL", f"file://{LOCAL_STORAGE_PATH}")
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 50))
+S3_MAX_WORKERS = int(os.environ.get("S3_MAX_WORKERS", 32))
+S3_CONNECT_TIMEOUT = float(os.environ.get("S3_CONNECT_TIMEOUT", 5))
+S3_READ_TIMEOUT = float(os.environ.get("S3_READ_TIMEOUT", 60))
+S3_MAX_ATTEMPTS = int(os.environ.get("S3_MAX_ATTEMPTS", 3))
+S3_URL_EXPIRES_IN = int(os.environ.get("S3_URL_EXPIRES_IN", 3600))
+PRESIGNED_URL_CACHE_SIZE = int(os.environ.get("PRESIGNED_URL_CACHE_SIZE", 100000))
+# cached URLs are replaced this long before their signature expires
+PRESIGNED_URL_REFRESH_MARGIN = int(os.environ.get("PRESIGNED_URL_REFRESH_MARGIN", 300))
+
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+IMAGE_QUEUE_LIMIT = int(os.environ.get("IMAGE_QUEUE_LIMIT", 16))
+IMAGE_JOB_TIMEOUT = float(os.environ.get("IMAGE_JOB_TIMEOUT", 20))
+
+VIDEO_WORKERS = int(os.environ.get("VIDEO_WORKERS", 1))
+VIDEO_QUEUE_LIMIT = int(os.environ.get("VIDEO_QUEUE_LIMIT", 4))
+VIDEO_JOB_TIMEOUT = float(os.environ.get("VIDEO_JOB_TIMEOUT", 300))
+# scratch space for transcoder input/output, defaults to the system temp dir
+TRANSCODE_TMP_DIR = os.environ.get("TRANSCODE_TMP_DIR") or None
+
+MEDIA_JOB_CONCURRENCY = int(os.environ.get("MEDIA_JOB_CONCURRENCY", 4))
+MEDIA_JOB_QUEUE_SIZE = int(os.environ.get("MEDIA_JOB_QUEUE_SIZE", 64))
+# finished jobs stay queryable this long
+MEDIA_JOB_RETENTION = float(os.environ.get("MEDIA_JOB_RETENTION", 3600))
+MEDIA_JOB_HISTORY_SIZE = int(os.environ.get("MEDIA_JOB_HISTORY_SIZE", 10000))
+
+# binary chunked uploads over the chat socket
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR", "/tmp/chat-uploads")
+UPLOAD_RESUME_TTL = float(os.environ.get("UPLOAD_RESUME_TTL", 600))
+UPLOAD_CHUNK_MAX_SIZE = int(os.environ.get("UPLOAD_CHUNK_MAX_SIZE", 512 * 1024))
+# per user: unfinished uploads and the spool space their announced sizes reserve
+UPLOAD_MAX_ACTIVE_PER_USER = int(os.environ.get("UPLOAD_MAX_ACTIVE_PER_USER", 3))
+UPLOAD_MAX_SPOOL_PER_USER = int(os.environ.get("UPLOAD_MAX_SPOOL_PER_USER", 100 * 1024 * 1024))
+# largest accepted WebSocket message; must hold one chunk plus its header
+WS_MAX_SIZE = int(os.environ.get("WS_MAX_SIZE", 1024 * 1024))
+
+MEDIA_DEDUP_CACHE_SIZE = int(os.environ.get("MEDIA_DEDUP_CACHE_SIZE", 100000))
+MEDIA_DEDUP_CACHE_TTL = float(os.environ.get("MEDIA_DEDUP_CACHE_TTL", 86400))
+# keys objects by an HMAC of their content hash, so a key can't be computed from the file
+MEDIA_KEY_SECRET = os.environ.get("MEDIA_KEY_SECRET", SECRET_AUTH)
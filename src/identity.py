@@ -0,0 +1,68 @@
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+from config import IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL
+from models.models import room, user
+
+# name -> id mappings shared by every hot-path write
+room_ids = TTLCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+user_ids = TTLCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+
+
+async def _resolve_many(session: AsyncSession, cache: TTLCache, name_column, id_column, names: Iterable[str]) \
+        -> Dict[str, int]:
+    resolved = {}
+    missing = set()
+    for name in set(names):
+        cached = cache.get(name)
+        if cached is None:
+            missing.add(name)
+        else:
+            resolved[name] = cached
+    if missing:
+        result = await session.execute(select(name_column, id_column).where(name_column.in_(missing)))
+        for name, id_ in result.fetchall():
+            cache.set(name, id_)
+            resolved[name] = id_
+    return resolved
+
+
+async def resolve_room_ids(session: AsyncSession, room_names: Iterable[str]) -> Dict[str, int]:
+    return await _resolve_many(session, room_ids, room.c.room_name, room.c.room_id, room_names)
+
+
+async def resolve_user_ids(session: AsyncSession, usernames: Iterable[str]) -> Dict[str, int]:
+    return await _resolve_many(session, user_ids, user.c.username, user.c.id, usernames)
+
+
+async def resolve_room_id(session: AsyncSession, room_name: str) -> int:
+    resolved = await resolve_room_ids(session, [room_name])
+    if room_name not in resolved:
+        raise NoResultFound(f"Room {room_name} does not exist")
+    return resolved[room_name]
+
+
+async def resolve_user_id(session: AsyncSession, username: str) -> int:
+    resolved = await resolve_user_ids(session, [username])
+    if username not in resolved:
+        raise NoResultFound(f"User {username} does not exist")
+    return resolved[username]
+
+
+def invalidate_room(room_name: str) -> None:
+    room_ids.pop(room_name)
+
+
+def invalidate_user(username: Optional[str] = None, user_id: Optional[int] = None) -> None:
+    if username is not None:
+        user_ids.pop(username)
+    if user_id is not None:
+        user_ids.discard_value(user_id)
+
+
+def stats() -> Dict[str, dict]:
+    return {"rooms": room_ids.stats(), "users": user_ids.stats()}
@@ -1,10 +1,12 @@
 import uvicorn
 
+from config import WS_MAX_SIZE
+
 if __name__ == '__main__':
     uvicorn.run(
         'app:app',
         host='0.0.0.0',
         port=8000,
         reload=True,
-        ws_max_size=60000000
+        ws_max_size=WS_MAX_SIZE
     )
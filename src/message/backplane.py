@@ -0,0 +1,296 @@
+import asyncio
+import base64
+import contextlib
+import glob
+import logging
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import asyncpg
+
+from config import BACKPLANE, BACKPLANE_CHANNEL, BACKPLANE_SOCKET_DIR, DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER
+from message import codec
+
+logger = logging.getLogger(__name__)
+
+# (room name, encoded event, whether the event carries a new message)
+Handler = Callable[[str, bytes, bool], Awaitable[None]]
+# (origin node id, payload) of messages between workers that aren't room events
+ControlHandler = Callable[[str, bytes], Awaitable[None]]
+
+# Postgres rejects NOTIFY payloads of 8000 bytes and more
+PG_NOTIFY_MAX_PAYLOAD = 7999
+# larger envelopes are sent base64 encoded in parts of this many bytes, leaving room for the part header
+PG_NOTIFY_PART_SIZE = (PG_NOTIFY_MAX_PAYLOAD - 64) // 4 * 3
+# parts of a message are sent in one transaction; leftovers of a lost connection are dropped after this
+PG_NOTIFY_PART_TTL = 60
+PG_RECONNECT_MAX_DELAY = 30
+
+
+class Backplane:
+    """Relays room messages to the other processes serving the same rooms."""
+
+    def __init__(self):
+        self.node_id = uuid4().hex
+        self.handler: Optional[Handler] = None
+        self.control_handlers: Dict[str, ControlHandler] = {}
+
+    async def start(self, handler: Handler) -> None:
+        self.handler = handler
+
+    async def stop(self) -> None:
+        self.handler = None
+
+    def on_control(self, kind: str, handler: ControlHandler) -> None:
+        self.control_handlers[kind] = handler
+
+    async def publish(self, room_name: str, payload: bytes, kind: Optional[str] = None,
+                      new_message: bool = False) -> None:
+        raise NotImplementedError
+
+    async def publish_control(self, kind: str, payload: bytes) -> None:
+        await self.publish("", payload, kind)
+
+    def _encode(self, room_name: str, payload: bytes, kind: Optional[str] = None, new_message: bool = False) -> bytes:
+        # header line + the already encoded event, so the event is never serialized twice
+        header = {"origin": self.node_id, "room": room_name}
+        if kind is not None:
+            header["kind"] = kind
+        if new_message:
+            header["new_message"] = True
+        return codec.dumps(header) + b"\n" + payload
+
+    async def _receive(self, envelope: bytes) -> None:
+        try:
+            header, payload = envelope.split(b"\n", 1)
+            header = codec.loads(header)
+        except ValueError as e:
+            logger.error(f"Malformed backplane payload: {e}")
+            return
+        # the publisher has already delivered to its own sockets
+        if header["origin"] == self.node_id or self.handler is None:
+            return
+        if "kind" in header:
+            control_handler = self.control_handlers.get(header["kind"])
+            if control_handler is not None:
+                await control_handler(header["origin"], payload)
+            return
+        await self.handler(header["room"], payload, header.get("new_message", False))
+
+
+class InProcessBackplane(Backplane):
+    """Backplanes created with the same hub see each other's messages; meant for tests."""
+
+    default_hub: Dict[str, "InProcessBackplane"] = {}
+
+    def __init__(self, hub: Optional[Dict[str, "InProcessBackplane"]] = None):
+        super().__init__()
+        self.hub = self.default_hub if hub is None else hub
+
+    async def start(self, handler: Handler) -> None:
+        await super().start(handler)
+        self.hub[self.node_id] = self
+
+    async def stop(self) -> None:
+        self.hub.pop(self.node_id, None)
+        await super().stop()
+
+    async def publish(self, room_name: str, payload: bytes, kind: Optional[str] = None,
+                      new_message: bool = False) -> None:
+        envelope = self._encode(room_name, payload, kind, new_message)
+        for node in list(self.hub.values()):
+            await node._receive(envelope)
+
+
+class UnixSocketBackplane(Backplane):
+    """Workers on one host exchange datagrams through sockets in a shared directory."""
+
+    def __init__(self, socket_dir: str = BACKPLANE_SOCKET_DIR):
+        super().__init__()
+        self.socket_dir = socket_dir
+        self.path = os.path.join(socket_dir, f"{self.node_id}.sock")
+        self.sock: Optional[socket.socket] = None
+
+    async def start(self, handler: Handler) -> None:
+        await super().start(handler)
+        os.makedirs(self.socket_dir, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(self.path)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._on_readable)
+
+    async def stop(self) -> None:
+        if self.sock is not None:
+            asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        await super().stop()
+
+    def _on_readable(self):
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return
+            asyncio.create_task(self._receive(data))
+
+    async def publish(self, room_name: str, payload: bytes, kind: Optional[str] = None,
+                      new_message: bool = False) -> None:
+        if self.sock is None:
+            return
+        envelope = self._encode(room_name, payload, kind, new_message)
+        for path in glob.glob(os.path.join(self.socket_dir, "*.sock")):
+            if path == self.path:
+                continue
+            try:
+                self.sock.sendto(envelope, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the worker that owned this socket is gone
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+            except BlockingIOError:
+                logger.warning(f"Backplane peer {path} is not keeping up, message dropped")
+            except OSError as e:
+                logger.error(f"Error publishing to backplane peer {path}: {e}")
+
+
+class PostgresBackplane(Backplane):
+    """LISTEN/NOTIFY on the application database, so workers on any host share rooms.
+
+    Envelopes too large for one NOTIFY are split into numbered parts and reassembled by the listeners.
+    Events published while the LISTEN connection is down are not replayed.
+    """
+
+    def __init__(self, channel: str = BACKPLANE_CHANNEL):
+        super().__init__()
+        self.channel = channel
+        self.listener: Optional[asyncpg.Connection] = None
+        self.publisher: Optional[asyncpg.Connection] = None
+        self.publish_lock = asyncio.Lock()
+        self.reconnect_task: Optional[asyncio.Task] = None
+        # message id -> (first part received at, parts)
+        self.partial: Dict[str, Tuple[float, List[Optional[bytes]]]] = {}
+
+    async def _connect(self) -> asyncpg.Connection:
+        return await asyncpg.connect(user=DB_USER, password=DB_PASS, host=DB_HOST, port=int(DB_PORT), database=DB_NAME)
+
+    async def start(self, handler: Handler) -> None:
+        await super().start(handler)
+        await self._listen()
+        self.publisher = await self._connect()
+
+    async def stop(self) -> None:
+        # unset first so closing the listener doesn't look like a lost connection
+        await super().stop()
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.reconnect_task
+            self.reconnect_task = None
+        for connection in (self.listener, self.publisher):
+            await self._close(connection)
+        self.listener = self.publisher = None
+        self.partial.clear()
+
+    async def _listen(self) -> None:
+        self.listener = await self._connect()
+        self.listener.add_termination_listener(self._on_terminate)
+        await self.listener.add_listener(self.channel, self._on_notify)
+
+    def _on_terminate(self, connection):
+        if self.handler is None or connection is not self.listener:
+            return
+        logger.error("Backplane LISTEN connection lost, reconnecting")
+        if self.reconnect_task is None or self.reconnect_task.done():
+            self.reconnect_task = asyncio.create_task(self._relisten())
+
+    async def _relisten(self):
+        delay = 1
+        while self.handler is not None:
+            try:
+                await self._listen()
+                logger.warning("Backplane LISTEN connection restored")
+                return
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as e:
+                logger.error(f"Error reconnecting backplane listener, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, PG_RECONNECT_MAX_DELAY)
+
+    @staticmethod
+    async def _close(connection: Optional[asyncpg.Connection]):
+        if connection is None or connection.is_closed():
+            return
+        try:
+            await connection.close(timeout=5)
+        except Exception as e:
+            logger.debug(f"Error closing backplane connection: {e}")
+            connection.terminate()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        if not payload.startswith("#"):
+            asyncio.create_task(self._receive(payload.encode()))
+            return
+        envelope = self._add_part(payload)
+        if envelope is not None:
+            asyncio.create_task(self._receive(envelope))
+
+    def _add_part(self, payload: str) -> Optional[bytes]:
+        try:
+            message_id, index, count, data = payload[1:].split(" ", 3)
+            index, count = int(index), int(count)
+            part = base64.b64decode(data)
+        except ValueError as e:
+            logger.error(f"Malformed backplane part: {e}")
+            return None
+        now = time.monotonic()
+        if index == 0:
+            for stale in [key for key, (received, _) in self.partial.items() if received < now - PG_NOTIFY_PART_TTL]:
+                del self.partial[stale]
+        _, parts = self.partial.setdefault(message_id, (now, [None] * count))
+        parts[index] = part
+        if any(p is None for p in parts):
+            return None
+        del self.partial[message_id]
+        return b"".join(parts)
+
+    def _split(self, envelope: bytes) -> List[str]:
+        if len(envelope) <= PG_NOTIFY_MAX_PAYLOAD:
+            return [envelope.decode()]
+        message_id = uuid4().hex
+        chunks = [envelope[i:i + PG_NOTIFY_PART_SIZE] for i in range(0, len(envelope), PG_NOTIFY_PART_SIZE)]
+        return [f"#{message_id} {index} {len(chunks)} {base64.b64encode(chunk).decode()}"
+                for index, chunk in enumerate(chunks)]
+
+    async def publish(self, room_name: str, payload: bytes, kind: Optional[str] = None,
+                      new_message: bool = False) -> None:
+        notifications = self._split(self._encode(room_name, payload, kind, new_message))
+        async with self.publish_lock:
+            for attempt in (1, 2):
+                try:
+                    if self.publisher is None or self.publisher.is_closed():
+                        self.publisher = await self._connect()
+                    # one statement is one transaction: the parts are delivered together or not at all
+                    await self.publisher.execute(
+                        "SELECT pg_notify($1, part) FROM unnest($2::text[]) AS part", self.channel, notifications
+                    )
+                    return
+                except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as e:
+                    logger.error(f"Error publishing to backplane (attempt {attempt}): {e}")
+                    await self._close(self.publisher)
+                    self.publisher = None
+            raise ConnectionError(f"Backplane unavailable, message for room {room_name} not relayed")
+
+
+def create_backplane(kind: str = BACKPLANE) -> Backplane:
+    if kind == "postgres":
+        return PostgresBackplane()
+    if kind == "unix":
+        return UnixSocketBackplane()
+    if kind == "memory":
+        return InProcessBackplane()
+    raise ValueError(f"Unknown backplane: {kind}")
@@ -0,0 +1,109 @@
+import struct
+from typing import Any, Optional, Tuple, Union
+from uuid import UUID
+
+import orjson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+# offered by clients in the Sec-WebSocket-Protocol header to receive binary MessagePack frames
+SUBPROTOCOLS = {MSGPACK: MSGPACK} if msgpack is not None else {}
+
+# binary file chunk: marker byte, 16-byte upload id, 4-byte big-endian chunk number, then the raw bytes.
+# 0x00 never starts a JSON document or a MessagePack map, so chunks can't be mistaken for events.
+CHUNK_MARKER = 0x00
+CHUNK_HEADER = struct.Struct("!B16sI")
+
+
+def _default(obj: Any) -> Any:
+    # pydantic models (room members, messages) and anything else orjson doesn't know natively
+    if hasattr(obj, "dict"):
+        return obj.dict()
+    return str(obj)
+
+
+def _msgpack_default(obj: Any) -> Any:
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    return _default(obj)
+
+
+def dumps(event: Any) -> bytes:
+    return orjson.dumps(event, default=_default)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    return orjson.loads(data)
+
+
+def negotiate(subprotocols: list) -> Optional[str]:
+    for subprotocol in subprotocols:
+        if subprotocol in SUBPROTOCOLS:
+            return SUBPROTOCOLS[subprotocol]
+    return None
+
+
+def decode_frame(message: dict, encoding: str = JSON) -> Any:
+    if message.get("text") is not None:
+        return loads(message["text"])
+    if encoding == MSGPACK:
+        return msgpack.unpackb(message["bytes"])
+    return loads(message["bytes"])
+
+
+def is_chunk(message: dict) -> bool:
+    data = message.get("bytes")
+    return data is not None and len(data) >= CHUNK_HEADER.size and data[0] == CHUNK_MARKER
+
+
+def decode_chunk(data: bytes) -> Tuple[str, int, memoryview]:
+    _, upload_id, chunk_number = CHUNK_HEADER.unpack_from(data)
+    return UUID(bytes=upload_id).hex, chunk_number, memoryview(data)[CHUNK_HEADER.size:]
+
+
+def encode_chunk(upload_id: str, chunk_number: int, payload: bytes) -> bytes:
+    return CHUNK_HEADER.pack(CHUNK_MARKER, UUID(hex=upload_id).bytes, chunk_number) + payload
+
+
+class Frame:
+    """An outgoing event, serialized at most once per encoding and shared by every recipient."""
+
+    __slots__ = ("_event", "_json", "_text", "_msgpack")
+
+    def __init__(self, event: Any = None, encoded_json: Optional[bytes] = None):
+        self._event = event
+        self._json = encoded_json
+        self._text: Optional[str] = None
+        self._msgpack: Optional[bytes] = None
+
+    @property
+    def event(self) -> Any:
+        if self._event is None:
+            self._event = loads(self._json)
+        return self._event
+
+    def json(self) -> bytes:
+        if self._json is None:
+            self._json = dumps(self._event)
+        return self._json
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.json().decode()
+        return self._text
+
+    def msgpack(self) -> bytes:
+        if self._msgpack is None:
+            self._msgpack = msgpack.packb(self.event, default=_msgpack_default)
+        return self._msgpack
+
+    def payload(self, encoding: str = JSON) -> Union[str, bytes]:
+        if encoding == MSGPACK:
+            return self.msgpack()
+        return self.text()
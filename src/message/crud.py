@@ -1,70 +1,155 @@
 import logging
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 
-from sqlalchemy import select, insert
+from sqlalchemy import select, literal, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from aws.service import upload_from_base64
-from message.schemas import MessageRead, MemberRead
+from aws.utils import media_urls, signed_variants, variant_keys
+from config import MESSAGE_PAGE_SIZE, MESSAGE_PAGE_MAX_SIZE
+from message.recent import recent_messages
+from message.schemas import MessageRead, MemberRead, MessagePage
 from models.models import room, user, message, room_user
-from user.crud import get_user_by_id
+from pagination import clamp_limit, decode_cursor, encode_cursor
+from user.schemas import UserReadRequest
 
 logger = logging.getLogger(__name__)
 
 
-async def upload_message_to_room(session: AsyncSession, room_name: str, user_name: str, message_data: str):
-    try:
-        room_id = (await session.execute(select(room).filter_by(room_name=room_name))).scalar_one()
-        user_id = (await session.execute(select(user).filter_by(username=user_name))).scalar_one()
-        await session.execute(insert(message).values(message_data=message_data, user=user_id, room=room_id))
-        await session.commit()
-        return True
-    except Exception as e:
-        logger.error(f"Error adding message to DB: {type(e)} {e}")
-        await session.rollback()
-        return False
-
-
-async def upload_message_with_file_to_room(session: AsyncSession,
-                                           room_name: str,
-                                           user_name: str,
-                                           data_message:str,
-                                           base64_data: str,
-                                           file_type: str) -> str:
-    try:
-        room_id = (await session.execute(select(room).filter_by(room_name=room_name))).scalar_one()
-        user_id = (await session.execute(select(user).filter_by(username=user_name))).scalar_one()
-        media_file_url = await upload_from_base64(base64_data, file_type)
-        if "https" not in media_file_url.file_name:
-            media_file_url = "https://f003.backblazeb2.com/file/gleb-bucket/" + media_file_url.file_name
-        else:
-            media_file_url = media_file_url.file_name
-        await session.execute(
-            insert(message).values(user=user_id, room=room_id, message_data=data_message, media_file_url=media_file_url, ))
-        await session.commit()
-        return media_file_url
-    except Exception as e:
-        logger.error(f"Error adding message to DB: {type(e)} {e}")
-        await session.rollback()
-
-
-async def get_messages_in_room(session: AsyncSession, room_id: int) -> List[MessageRead]:
-    result = await session.execute(
-        select(message)
-        .join(room, room.c.room_id == message.c.room)
-        .where(room.c.room_id == room_id)
+def _message_from_row(row) -> MessageRead:
+    # object keys as stored, see sign_messages
+    return MessageRead(
+        message_id=row.message_id,
+        message=row.message_data,
+        media_file_url=row.media_file_url,
+        media_variants=row.media_variants,
+        media_width=row.media_width,
+        media_height=row.media_height,
+        media_duration=row.media_duration,
+        creation_date=row.creation_date,
+        user=UserReadRequest(
+            user_id=row.user_id,
+            username=row.username,
+            email=row.email,
+            image_url=row.image_url
+        ),
     )
-    rows = result.fetchall()
-    messages: List[MessageRead] = list()
-    for row in rows:
-        user_read_request = await get_user_by_id(session, row[4])
-        messages.append(MessageRead(
-            message=row[1],
-            media_file_url=row[2],
-            user=user_read_request,
-        ))
+
+
+def sign_messages(messages: List[MessageRead]) -> List[MessageRead]:
+    """
+    Copies of messages holding object keys, with the keys replaced by (cached) presigned URLs
+    """
+    urls = media_urls([m.media_file_url for m in messages] + [m.user.image_url for m in messages]
+                      + [key for m in messages for key in variant_keys(m.media_variants)])
+    return [
+        m.copy(update={
+            "media_file_url": urls.get(m.media_file_url),
+            "media_variants": signed_variants(m.media_variants, urls),
+            "user": m.user.copy(update={"image_url": urls.get(m.user.image_url)}),
+        })
+        for m in messages
+    ]
+
+
+async def get_author(session: AsyncSession, user_name: str) -> Optional[UserReadRequest]:
+    """
+    The author fields of a user's messages, with the avatar as an object key
+    """
+    row = (await session.execute(
+        select(user.c.id, user.c.username, user.c.email, user.c.image_url).where(user.c.username == user_name)
+    )).first()
     await session.commit()
-    return messages
+    if row is None:
+        return None
+    return UserReadRequest(user_id=row.id, username=row.username, email=row.email, image_url=row.image_url)
+
+
+async def get_message_history(session: AsyncSession, room_id: int, before: Optional[str] = None,
+                              after: Optional[str] = None, limit: int = MESSAGE_PAGE_SIZE,
+                              raw: bool = False) -> MessagePage:
+    """
+    One page of a room's messages in chronological order, joined with their authors.
+    Without a cursor the newest page is returned; `before`/`after` take the page's older/newer cursor.
+    `raw` leaves object keys unsigned.
+    """
+    limit = clamp_limit(limit, MESSAGE_PAGE_MAX_SIZE)
+    position = tuple_(message.c.creation_date, message.c.message_id)
+    query = (
+        select(
+            message.c.message_id,
+            message.c.message_data,
+            message.c.media_file_url,
+            message.c.media_variants,
+            message.c.media_width,
+            message.c.media_height,
+            message.c.media_duration,
+            message.c.creation_date,
+            user.c.id.label("user_id"),
+            user.c.username,
+            user.c.email,
+            user.c.image_url,
+        )
+        .join(user, user.c.id == message.c.user)
+        .where(message.c.room == room_id)
+    )
+    newer = after is not None
+    cursor = after if newer else before
+    if cursor is not None:
+        creation_date, message_id = decode_cursor(cursor)
+        if not isinstance(creation_date, str) or not isinstance(message_id, int) or isinstance(message_id, bool):
+            raise ValueError("Malformed pagination cursor")
+        bound = tuple_(literal(datetime.fromisoformat(creation_date)), literal(message_id))
+        query = query.where(position > bound if newer else position < bound)
+    if newer:
+        query = query.order_by(message.c.creation_date.asc(), message.c.message_id.asc())
+    else:
+        query = query.order_by(message.c.creation_date.desc(), message.c.message_id.desc())
+    rows = (await session.execute(query.limit(limit + 1))).fetchall()
+    await session.commit()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not newer:
+        rows.reverse()
+    messages = [_message_from_row(row) for row in rows]
+    page = MessagePage(messages=messages if raw else sign_messages(messages))
+    if messages:
+        first, last = messages[0], messages[-1]
+        if has_more or newer:
+            page.older_cursor = encode_cursor(first.creation_date, first.message_id)
+        if (has_more and newer) or (not newer and cursor is not None):
+            page.newer_cursor = encode_cursor(last.creation_date, last.message_id)
+    return page
+
+
+async def get_recent_messages(session: AsyncSession, room_id: int, room_name: str,
+                              limit: int = MESSAGE_PAGE_SIZE) -> MessagePage:
+    """
+    The newest page of a room, from the in-memory tail when the room is hot
+    """
+    limit = clamp_limit(limit, MESSAGE_PAGE_MAX_SIZE)
+    cached = recent_messages.get(room_name, limit)
+    if cached is None:
+        # read a whole tail's worth so later opens with a smaller limit are served from memory too
+        generation = recent_messages.begin_warm(room_name)
+        try:
+            page = await get_message_history(session, room_id, limit=max(limit, recent_messages.per_room),
+                                             raw=True)
+            recent_messages.warm(room_name, page.messages, page.older_cursor is None, generation)
+        finally:
+            recent_messages.end_warm(room_name)
+        cached = page.messages[-limit:], len(page.messages) > limit or page.older_cursor is not None
+    messages, has_older = cached
+    page = MessagePage(messages=sign_messages(messages))
+    if messages and has_older:
+        page.older_cursor = encode_cursor(messages[0].creation_date, messages[0].message_id)
+    return page
+
+
+async def get_messages_in_room(session: AsyncSession, room_id: int, room_name: str,
+                               limit: int = MESSAGE_PAGE_SIZE) -> List[MessageRead]:
+    page = await get_recent_messages(session, room_id, room_name, limit)
+    return page.messages
 
 
 async def get_members_in_room(session: AsyncSession, room_id: int) -> List[MemberRead]:
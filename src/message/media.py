@@ -0,0 +1,175 @@
+import asyncio
+import logging
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+from fastapi import HTTPException
+
+from aws.schemas import FileRead
+from aws.service import upload_from_base64, upload_from_path
+from aws.utils import media_url, media_urls, signed_variants, variant_keys
+from cache import TTLCache
+from config import MEDIA_JOB_CONCURRENCY, MEDIA_JOB_QUEUE_SIZE, MEDIA_JOB_RETENTION, MEDIA_JOB_HISTORY_SIZE
+from message.notifier import ConnectionManager
+from message.uploads import remove_spool_file
+from message.writer import MessageWriter
+from user.schemas import UserReadRequest
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    PROCESSING = "processing"
+    READY = "ready"
+    FAILED = "failed"
+
+
+class MediaQueueFull(Exception):
+    pass
+
+
+class MediaJob:
+    def __init__(self, room_name: str, user_name: str, message_data: str, file_type: str,
+                 content: Optional[str] = None, source_path: Optional[str] = None,
+                 content_hash: Optional[str] = None, author: Optional[UserReadRequest] = None):
+        self.job_id = uuid4().hex
+        self.room_name = room_name
+        self.user_name = user_name
+        self.message_data = message_data
+        self.file_type = file_type
+        # either a base64 payload, released as soon as the job is processed, or a spooled file removed then
+        self.content = content
+        self.source_path = source_path
+        self.content_hash = content_hash
+        self.author = author
+        self.status = JobStatus.QUEUED
+        self.error: Optional[str] = None
+        self.media_file: Optional[FileRead] = None
+        self.message_id: Optional[int] = None
+        self.creation_date = datetime.utcnow()
+        self.update_date = self.creation_date
+
+    def set_status(self, status: JobStatus, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        self.update_date = datetime.utcnow()
+
+    def media_fields(self) -> Dict[str, Any]:
+        """The stored media with signed URLs, named like the message columns"""
+        if self.media_file is None:
+            return {}
+        media_file = self.media_file
+        return {
+            "media_file_url": media_url(media_file.file_name),
+            "media_variants": signed_variants(media_file.variants, media_urls(variant_keys(media_file.variants))),
+            "media_width": media_file.width,
+            "media_height": media_file.height,
+            "media_duration": media_file.duration,
+        }
+
+    def event(self) -> Dict[str, Any]:
+        return {
+            "type": "media_job",
+            "job_id": self.job_id,
+            "status": self.status,
+            "message": self.message_data,
+            "user": {"username": self.user_name},
+            "room_name": self.room_name,
+            "error": self.error,
+        }
+
+
+class MediaJobQueue:
+    """Processes file messages in the background, a bounded number at a time, and reports progress to the room.
+
+    Job state lives in this process only; with several workers a job is visible on the one that accepted it.
+    """
+
+    def __init__(self, manager: ConnectionManager, writer: MessageWriter,
+                 concurrency: int = MEDIA_JOB_CONCURRENCY, queue_size: int = MEDIA_JOB_QUEUE_SIZE,
+                 retention: float = MEDIA_JOB_RETENTION, history_size: int = MEDIA_JOB_HISTORY_SIZE):
+        self.manager = manager
+        self.writer = writer
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+        self.jobs = TTLCache(history_size, retention)
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        if not self.tasks:
+            return
+        # one sentinel per worker: jobs queued before shutdown are still finished
+        for _ in self.tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self.tasks)
+        self.tasks = []
+
+    def submit(self, room_name: str, user_name: str, message_data: str, file_type: str,
+               content: Optional[str] = None, source_path: Optional[str] = None,
+               content_hash: Optional[str] = None, author: Optional[UserReadRequest] = None) -> MediaJob:
+        job = MediaJob(room_name, user_name, message_data, file_type, content, source_path, content_hash, author)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise MediaQueueFull()
+        self.jobs.set(job.job_id, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[MediaJob]:
+        return self.jobs.get(job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.concurrency,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "max_queued": self.queue_size,
+            "tracked": len(self.jobs.data),
+        }
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            if job is None:
+                return
+            await self._process(job)
+
+    async def _process(self, job: MediaJob):
+        job.set_status(JobStatus.PROCESSING)
+        await self.manager.broadcast(job.room_name, job.event())
+        try:
+            if job.source_path is not None:
+                media_file = await upload_from_path(job.source_path, job.file_type, job.content_hash)
+            else:
+                media_file = await upload_from_base64(job.content, job.file_type)
+            job.media_file = media_file
+            # persisted in the writer's next batch, like a text message
+            pending = await self.writer.submit(job.room_name, job.user_name, job.message_data, media_file, job.author)
+        except Exception as e:
+            error = e.detail if isinstance(e, HTTPException) else "File could not be processed."
+            logger.error(f"Media job {job.job_id} for room {job.room_name} failed: {type(e)} {e}")
+            job.set_status(JobStatus.FAILED, str(error))
+            await self.manager.broadcast(job.room_name, job.event())
+            return
+        finally:
+            job.content = None
+            if job.source_path is not None:
+                await asyncio.get_running_loop().run_in_executor(None, remove_spool_file, job.source_path)
+                job.source_path = None
+        job.message_id = pending.message_id
+        job.set_status(JobStatus.READY)
+        # the final event keeps the shape of the former inline file message
+        await self.manager.broadcast(job.room_name, {
+            **job.event(),
+            "type": "file",
+            "message_id": pending.message_id,
+            "creation_date": pending.creation_date,
+            **job.media_fields(),
+        }, new_message=True)
@@ -1,33 +1,173 @@
+import asyncio
 import logging
-from typing import List
+from enum import Enum
+from typing import Any, Callable, Dict, Optional, Union
 
 from fastapi import WebSocket
-from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.websockets import WebSocketState
 
-from room.crud import set_room_activity
+from config import WS_SEND_QUEUE_SIZE, WS_SEND_TIMEOUT, WS_OVERFLOW_POLICY
+from message import codec
+from message.backplane import Backplane, create_backplane
+from message.codec import Frame
+from presence import PresenceTracker, presence as default_presence
 
 logger = logging.getLogger(__name__)
 
+# 1013 "Try Again Later": the client should reconnect and resync from the room snapshot
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class OverflowPolicy(str, Enum):
+    # drop_oldest and drop_backlog lose messages: the client only finds out by refetching the history
+    DROP_OLDEST = "drop_oldest"
+    DROP_BACKLOG = "drop_backlog"
+    DISCONNECT = "disconnect"
+
+
+class Connection:
+    def __init__(self, websocket: WebSocket, user_name: str,
+                 encoding: str = codec.JSON,
+                 max_queue: int = WS_SEND_QUEUE_SIZE,
+                 policy: OverflowPolicy = OverflowPolicy(WS_OVERFLOW_POLICY),
+                 send_timeout: float = WS_SEND_TIMEOUT):
+        self.websocket = websocket
+        self.user_name = user_name
+        self.encoding = encoding
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.closed = False
+        self.writer: Optional[asyncio.Task] = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, frame: Frame) -> bool:
+        if self.closed:
+            return False
+        if self.queue.full():
+            if self.policy == OverflowPolicy.DISCONNECT:
+                logger.warning(f"Evicting slow consumer {self.user_name}: send queue is full")
+                self.evict()
+                return False
+            if self.policy == OverflowPolicy.DROP_BACKLOG:
+                # throw away every pending frame, chat messages included, and keep only the newest
+                self.dropped += self.queue.qsize()
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+            else:
+                self.dropped += 1
+                self.queue.get_nowait()
+        self.queue.put_nowait(frame)
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                payload = frame.payload(self.encoding)
+                if isinstance(payload, bytes):
+                    send = self.websocket.send_bytes(payload)
+                else:
+                    send = self.websocket.send_text(payload)
+                await asyncio.wait_for(send, timeout=self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Dropping connection of {self.user_name}: {type(e).__name__} {e}")
+            self.writer = None
+            self.evict()
+
+    def evict(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is not None:
+            self.writer.cancel()
+        asyncio.create_task(self._close(SLOW_CONSUMER_CLOSE_CODE))
+
+    async def _close(self, code: int):
+        # closing makes the endpoint's receive loop exit and run the regular disconnect path
+        if self.websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                await self.websocket.close(code=code)
+            except Exception as e:
+                logger.debug(f"Error closing websocket of {self.user_name}: {e}")
+
+    def close(self):
+        self.closed = True
+        if self.writer is not None:
+            self.writer.cancel()
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, session: AsyncSession, websocket: WebSocket, room_name: str):
-        await websocket.accept()
-        await set_room_activity(session, room_name, True)
-        self.active_connections.append(websocket)
-
-    async def disconnect(self, session: AsyncSession, websocket: WebSocket, room_name: str):
-        self.active_connections.remove(websocket)
-        if len(self.active_connections) == 0:
-            await set_room_activity(session, room_name, False)
-
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str):
-        logger.debug(f"Broadcasting across {len(self.active_connections)} CONNECTIONS")
-        for connection in self.active_connections:
-            await connection.send_text(message)
-            logger.debug(f"Broadcasting: {message}")
+    def __init__(self, backplane: Optional[Backplane] = None,
+                 on_remote_message: Optional[Callable[[str], None]] = None,
+                 presence: PresenceTracker = default_presence):
+        self.presence = presence
+        self.backplane = backplane if backplane is not None else create_backplane()
+        # told the room of every new message relayed from another worker
+        self.on_remote_message = on_remote_message
+        # room_name -> {websocket: connection}; dicts keep insertion order and give O(1) join/leave
+        self.rooms: Dict[str, Dict[WebSocket, Connection]] = {}
+        self.connections: Dict[WebSocket, Connection] = {}
+
+    async def start(self):
+        await self.backplane.start(self.deliver)
+
+    async def stop(self):
+        await self.backplane.stop()
+
+    async def connect(self, websocket: WebSocket, room_name: str, user_name: str):
+        encoding = codec.negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=encoding)
+        connections = self.rooms.setdefault(room_name, {})
+        await self.presence.join(room_name, user_name)
+        connection = Connection(websocket, user_name, encoding or codec.JSON)
+        connections[websocket] = connection
+        self.connections[websocket] = connection
+
+    async def disconnect(self, websocket: WebSocket, room_name: str):
+        connections = self.rooms.get(room_name)
+        if connections is None or websocket not in connections:
+            return
+        connection = connections.pop(websocket)
+        del self.connections[websocket]
+        connection.close()
+        await self.presence.leave(room_name, connection.user_name)
+        if not connections:
+            del self.rooms[room_name]
+
+    def encoding_of(self, websocket: WebSocket) -> str:
+        connection = self.connections.get(websocket)
+        return connection.encoding if connection is not None else codec.JSON
+
+    async def send_personal_message(self, message: Union[Any, Frame], websocket: WebSocket):
+        frame = message if isinstance(message, Frame) else Frame(message)
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            connection.enqueue(frame)
+        else:
+            await websocket.send_text(frame.text())
+
+    async def broadcast(self, room_name: str, message: Union[Any, Frame], new_message: bool = False):
+        # the event is serialized once here and the same buffer is shared by every recipient
+        frame = message if isinstance(message, Frame) else Frame(message)
+        await self._deliver(room_name, frame)
+        try:
+            await self.backplane.publish(room_name, frame.json(), new_message=new_message)
+        except Exception as e:
+            logger.error(f"Error relaying message for room {room_name} to other workers: {type(e)} {e}")
+
+    async def deliver(self, room_name: str, payload: bytes, new_message: bool = False):
+        if new_message and self.on_remote_message is not None:
+            self.on_remote_message(room_name)
+        await self._deliver(room_name, Frame(encoded_json=payload))
+
+    async def _deliver(self, room_name: str, frame: Frame):
+        connections = self.rooms.get(room_name)
+        if not connections:
+            return
+        logger.debug(f"Broadcasting to {len(connections)} CONNECTIONS in room {room_name}")
+        # enqueueing never awaits, so one slow client can't hold up the rest of the room
+        for connection in list(connections.values()):
+            connection.enqueue(frame)
@@ -0,0 +1,141 @@
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+from config import RECENT_MESSAGES_PER_ROOM, RECENT_MESSAGES_MAX_TOTAL, RECENT_MESSAGES_SETTLE_TIME
+from message.schemas import MessageRead
+
+
+class RoomTail:
+    __slots__ = ("messages", "complete")
+
+    def __init__(self, size: int, complete: bool):
+        self.messages: Deque[MessageRead] = deque(maxlen=size)
+        # the room has no messages older than the ones held here
+        self.complete = complete
+
+
+class RecentMessages:
+    """The newest messages of recently used rooms, so opening a room doesn't query the history table.
+
+    Messages are held with object keys, not URLs: they are signed on the way out and never go stale.
+    Rooms are evicted least recently used first once `max_total` messages are held overall.
+    """
+
+    def __init__(self, per_room: int = RECENT_MESSAGES_PER_ROOM, max_total: int = RECENT_MESSAGES_MAX_TOTAL,
+                 settle_time: float = RECENT_MESSAGES_SETTLE_TIME):
+        self.per_room = per_room
+        self.max_total = max_total
+        self.settle_time = settle_time
+        self.rooms: "OrderedDict[str, RoomTail]" = OrderedDict()
+        self.total = 0
+        # messages accepted by the writer but possibly not yet in the table, merged in when a room is warmed
+        self.unflushed: Dict[str, Dict[int, MessageRead]] = {}
+        # rooms written to by another worker are served from the database until its writes have landed
+        self.unsettled: Dict[str, float] = {}
+        # room -> database reads in progress to warm it, and a generation bumped whenever one of its
+        # messages settles meanwhile: such a message may be in neither the page read nor `unflushed`
+        self.warming: Dict[str, int] = {}
+        self.generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, room_name: str, limit: int) -> Optional[Tuple[List[MessageRead], bool]]:
+        """The newest `limit` messages and whether older ones exist, or None if the room isn't cached"""
+        tail = self.rooms.get(room_name)
+        if tail is None or (len(tail.messages) < limit and not tail.complete):
+            self.misses += 1
+            return None
+        self.rooms.move_to_end(room_name)
+        self.hits += 1
+        messages = list(tail.messages)[-limit:] if limit < len(tail.messages) else list(tail.messages)
+        has_older = len(tail.messages) > len(messages) or not tail.complete
+        return messages, has_older
+
+    def begin_warm(self, room_name: str) -> int:
+        """Call before reading the page to warm the room with; pass the result to warm, then call end_warm"""
+        self.warming[room_name] = self.warming.get(room_name, 0) + 1
+        return self.generations.setdefault(room_name, 0)
+
+    def end_warm(self, room_name: str) -> None:
+        remaining = self.warming.get(room_name, 0) - 1
+        if remaining > 0:
+            self.warming[room_name] = remaining
+        else:
+            self.warming.pop(room_name, None)
+            self.generations.pop(room_name, None)
+
+    def warm(self, room_name: str, messages: List[MessageRead], complete: bool, generation: int) -> None:
+        """Cache a room from the newest page read from the database, `complete` if that page is all there is"""
+        if self.generations.get(room_name) != generation:
+            # a message was flushed while the page was read and may be missing from it
+            return
+        settle_until = self.unsettled.get(room_name)
+        if settle_until is not None:
+            if settle_until > time.monotonic():
+                return
+            del self.unsettled[room_name]
+        merged = {m.message_id: m for m in messages}
+        merged.update(self.unflushed.get(room_name, {}))
+        ordered = sorted(merged.values(), key=lambda m: (m.creation_date, m.message_id))
+        self.drop(room_name)
+        tail = RoomTail(self.per_room, complete and len(ordered) <= self.per_room)
+        tail.messages.extend(ordered)
+        self.rooms[room_name] = tail
+        self.total += len(tail.messages)
+        self._evict()
+
+    def append(self, room_name: str, message: MessageRead) -> None:
+        self.unflushed.setdefault(room_name, {})[message.message_id] = message
+        tail = self.rooms.get(room_name)
+        if tail is None:
+            return
+        if len(tail.messages) == tail.messages.maxlen:
+            tail.complete = False
+        else:
+            self.total += 1
+        tail.messages.append(message)
+        self.rooms.move_to_end(room_name)
+        self._evict()
+
+    def settled(self, messages: Iterable[Tuple[str, int]]) -> None:
+        """(room name, message id) pairs the writer is done with, persisted or not"""
+        for room_name, message_id in messages:
+            pending = self.unflushed.get(room_name)
+            if room_name in self.generations:
+                self.generations[room_name] += 1
+            if pending is not None:
+                pending.pop(message_id, None)
+                if not pending:
+                    del self.unflushed[room_name]
+
+    def invalidate(self, room_name: str) -> None:
+        """A message was written elsewhere: stop serving the room from memory until it is in the database"""
+        self.drop(room_name)
+        self.unsettled[room_name] = time.monotonic() + self.settle_time
+
+    def drop(self, room_name: str) -> None:
+        tail = self.rooms.pop(room_name, None)
+        if tail is not None:
+            self.total -= len(tail.messages)
+
+    def _evict(self) -> None:
+        while self.total > self.max_total and len(self.rooms) > 1:
+            _, tail = self.rooms.popitem(last=False)
+            self.total -= len(tail.messages)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "rooms": len(self.rooms),
+            "messages": self.total,
+            "max_messages": self.max_total,
+            "unflushed": sum(len(pending) for pending in self.unflushed.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+recent_messages = RecentMessages()
@@ -1,77 +1,163 @@
-import json
 import logging
+from typing import Optional
 
-from fastapi import WebSocket, APIRouter, Depends
-from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import WebSocket, APIRouter, Depends, HTTPException, status
 from starlette.websockets import WebSocketState, WebSocketDisconnect
 
-from database import get_async_session
-from message.crud import upload_message_to_room, upload_message_with_file_to_room
+from auth.base_config import fastapi_users
+from auth.schemas import UserRead
+from database import async_session_maker
+from message import codec
+from message.crud import get_author
+from message.media import MediaJobQueue, MediaQueueFull
 from message.notifier import ConnectionManager
-from room.crud import set_user_room_activity, get_room, add_user_to_room
+from message.recent import recent_messages
+from message.schemas import MediaJobRead
+from message.uploads import UploadRegistry, UploadError, remove_spool_file
+from message.writer import MessageWriter
+from room.crud import get_room_snapshot, add_user_to_room
+from user.schemas import UserReadRequest
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
-manager = ConnectionManager()
+jobs_router = APIRouter()
+# another worker's messages aren't in this worker's room tails
+manager = ConnectionManager(on_remote_message=recent_messages.invalidate)
+writer = MessageWriter()
+media_jobs = MediaJobQueue(manager, writer)
+uploads = UploadRegistry()
+
+UPLOAD_EVENTS = ("file_begin", "file_commit", "file_cancel")
+
+
+def _upload_error(upload_id: Optional[str], error: UploadError) -> dict:
+    return {"type": "file_error", "upload_id": upload_id, "error": error.detail, "offset": error.offset}
+
+
+async def _submit_media_job(websocket: WebSocket, room_name: str, author: Optional[UserReadRequest], user_name: str,
+                            message: str, file_type: str, content: Optional[str] = None,
+                            source_path: Optional[str] = None, content_hash: Optional[str] = None):
+    try:
+        job = media_jobs.submit(room_name, user_name, message, file_type, content, source_path, content_hash,
+                                author)
+    except MediaQueueFull:
+        if source_path is not None:
+            remove_spool_file(source_path)
+        await manager.send_personal_message({
+            "type": "media_job",
+            "status": "failed",
+            "message": message,
+            "error": "The server is busy processing other files. Try again later.",
+        }, websocket)
+        return
+    # the sender gets the job id right away, progress and the result go to the whole room
+    await manager.send_personal_message(job.event(), websocket)
+
+
+async def _handle_upload(websocket: WebSocket, room_name: str, author: Optional[UserReadRequest], user_name: str,
+                         message_data: dict):
+    """
+    file_begin starts or resumes an upload, binary chunks follow, file_commit turns it into a message
+    """
+    upload_id = message_data.get("upload_id")
+    try:
+        if message_data["type"] == "file_begin":
+            try:
+                size = int(message_data.get("size", 0))
+            except (TypeError, ValueError):
+                raise UploadError("File size must be a number of bytes.")
+            upload = uploads.begin(room_name, user_name, message_data.get("message", ""),
+                                   message_data.get("fileType"), size, upload_id)
+            await manager.send_personal_message(upload.state(), websocket)
+        elif message_data["type"] == "file_commit":
+            upload = await uploads.commit(upload_id, user_name)
+            await _submit_media_job(websocket, room_name, author, user_name, upload.message_data, upload.file_type,
+                                    source_path=upload.path, content_hash=upload.hasher.hexdigest())
+        else:
+            await uploads.cancel(upload_id, user_name)
+    except UploadError as e:
+        await manager.send_personal_message(_upload_error(upload_id, e), websocket)
 
 
 @router.websocket("/ws/{room_name}/{user_name}")
 async def websocket_endpoint(
         websocket: WebSocket,
         room_name: str,
-        user_name: str,
-        session: AsyncSession = Depends(get_async_session)
+        user_name: str
 ):
-    # Connect the user to the WebSocket
-    await manager.connect(session, websocket, room_name)
-    is_new = await add_user_to_room(session, user_name, room_name)
-    if is_new is False:
-        await set_user_room_activity(session, user_name, room_name, True)
-    room = await get_room(session, room_name)
+    # sessions are borrowed from the pool per unit of work, an idle socket holds no DB connection
+    async with async_session_maker() as session:
+        # Connect the user to the WebSocket; presence is tracked in memory and written in batches
+        await manager.connect(websocket, room_name, user_name)
+        await add_user_to_room(session, user_name, room_name)
+        snapshot = await get_room_snapshot(session, room_name)
+        # every message on this socket has the same author, looked up once
+        author = await get_author(session, user_name)
+    # the full room state goes to the joining socket only, everyone else gets a small delta
+    if snapshot is not None:
+        await manager.send_personal_message({"type": "snapshot", **snapshot.dict()}, websocket)
     data = {
         "content": f"{user_name} has entered the chat",
         "user": {"username": user_name},
         "room_name": room_name,
         "type": "entrance",
-        "new_room_obj": {
-            "room_id": room.room_id,
-            "room_name": room_name,
-            "members": room.members,
-            "messages": room.messages,
-            "active": room.room_active,
-            "date_created": room.room_creation_date
-        },
+        "room_version": snapshot.room_version if snapshot is not None else None,
     }
-    await manager.broadcast(f"{json.dumps(data, default=str)}")
+    await manager.broadcast(room_name, data)
     # wait for messages
     try:
-        while True:
-            if websocket.application_state == WebSocketState.CONNECTED:
-                data = await websocket.receive_text()
-                message_data = json.loads(data)
-                message = message_data["message"]
-                if "type" in message_data and message_data["type"] == "file":
-                    content = message_data["content"]
-                    file_type = message_data["fileType"]
-                    media_file_url = await upload_message_with_file_to_room(session,
-                                                                            room_name, user_name,
-                                                                            message, content,
-                                                                            file_type)
-                    file_data = {
-                        "message": message,
-                        "media_file_url": media_file_url,
-                        "user": {"username": user_name},
-                        "type": "file",
-                    }
-                    await manager.broadcast(f"{json.dumps(file_data, default=str)}")
-                else:
-                    await upload_message_to_room(session, room_name, user_name, message)
-                    await manager.broadcast(f"{data}")
+        while websocket.application_state == WebSocketState.CONNECTED:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            if codec.is_chunk(frame):
+                upload_id, chunk_number, chunk = codec.decode_chunk(frame["bytes"])
+                try:
+                    await uploads.write(upload_id, chunk_number, chunk, user_name)
+                except UploadError as e:
+                    await manager.send_personal_message(_upload_error(upload_id, e), websocket)
+                continue
+            message_data = codec.decode_frame(frame, manager.encoding_of(websocket))
+            if message_data.get("type") in UPLOAD_EVENTS:
+                await _handle_upload(websocket, room_name, author, user_name, message_data)
+                continue
+            message = message_data["message"]
+            if "type" in message_data and message_data["type"] == "file":
+                # base64 in a JSON frame, kept for older clients; limited by WS_MAX_SIZE
+                await _submit_media_job(websocket, room_name, author, user_name, message, message_data["fileType"],
+                                        content=message_data["content"])
+            else:
+                # broadcast right away, the writer persists the message in the next batch
+                pending = await writer.submit(room_name, user_name, message, author=author)
+                message_data["message_id"] = pending.message_id
+                message_data["creation_date"] = pending.creation_date
+                await manager.broadcast(room_name, message_data, new_message=True)
     except WebSocketDisconnect as ex:
         template = "An exception of type {0} occurred. Arguments:\n{1!r}"
         error_message = template.format(type(ex).__name__, ex.args)
         logger.error(error_message)
+    finally:
         logger.warning("Disconnecting Websocket")
-        await set_user_room_activity(session, user_name, room_name, False)
-        await manager.disconnect(session, websocket, room_name)
+        await manager.disconnect(websocket, room_name)
+
+
+@jobs_router.get("/media-jobs/{job_id}", response_model=MediaJobRead)
+async def get_media_job(job_id: str, current_user: UserRead = Depends(fastapi_users.current_user())):
+    """
+    Get the status of a file message being processed
+    """
+    job = media_jobs.get(job_id)
+    if job is None or job.user_name != current_user.username:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Media job not found")
+    return MediaJobRead(
+        job_id=job.job_id,
+        status=job.status,
+        room_name=job.room_name,
+        message=job.message_data,
+        message_id=job.message_id,
+        **job.media_fields(),
+        error=job.error,
+        creation_date=job.creation_date,
+        update_date=job.update_date,
+    )
@@ -1,4 +1,5 @@
-from typing import Optional
+from datetime import datetime
+from typing import Dict, List, Optional, Union
 
 from pydantic import BaseModel
 
@@ -6,13 +7,42 @@ from user.schemas import UserReadRequest
 
 
 class MessageRead(BaseModel):
+    message_id: Optional[int] = None
     message: str
     media_file_url: Optional[str]
+    # variant name (thumb, medium, full) -> {"width", "height", <format>: URL}
+    media_variants: Optional[Dict[str, Dict[str, Union[int, str]]]] = None
+    media_width: Optional[int] = None
+    media_height: Optional[int] = None
+    media_duration: Optional[float] = None
+    creation_date: Optional[datetime] = None
     user: UserReadRequest
 
 
+class MessagePage(BaseModel):
+    messages: List[MessageRead]
+    older_cursor: Optional[str] = None
+    newer_cursor: Optional[str] = None
+
+
 class MemberRead(BaseModel):
     user_id: int
     username: str
     profile_pic_img_src: Optional[str]
     date_created: str
+
+
+class MediaJobRead(BaseModel):
+    job_id: str
+    status: str
+    room_name: str
+    message: str
+    message_id: Optional[int] = None
+    media_file_url: Optional[str] = None
+    media_variants: Optional[Dict[str, Dict[str, Union[int, str]]]] = None
+    media_width: Optional[int] = None
+    media_height: Optional[int] = None
+    media_duration: Optional[float] = None
+    error: Optional[str] = None
+    creation_date: datetime
+    update_date: datetime
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from contextlib import suppress
+from typing import Dict, Optional
+from uuid import uuid4
+
+from aws.constants import MB, SNIFF_SIZE, SUPPORTED_FILE_TYPES_FORM_MESSAGE, max_file_size
+from aws.probe import MediaMismatch, check_mime, sniff_mime
+from config import UPLOAD_SPOOL_DIR, UPLOAD_RESUME_TTL, UPLOAD_CHUNK_MAX_SIZE, UPLOAD_MAX_ACTIVE_PER_USER, \
+    UPLOAD_MAX_SPOOL_PER_USER
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    def __init__(self, detail: str, offset: Optional[int] = None):
+        super().__init__(detail)
+        self.detail = detail
+        # bytes the server holds, the client resumes from here
+        self.offset = offset
+
+
+class ChunkedUpload:
+    def __init__(self, room_name: str, user_name: str, message_data: str, file_type: str, size: int,
+                 spool_dir: str):
+        self.upload_id = uuid4().hex
+        self.room_name = room_name
+        self.user_name = user_name
+        self.message_data = message_data
+        self.file_type = file_type
+        self.size = size
+        self.path = os.path.join(spool_dir, self.upload_id)
+        self.received = 0
+        self.next_chunk = 0
+        # content hash computed as chunks arrive, for deduplication
+        self.hasher = hashlib.sha256()
+        self.last_activity = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def state(self) -> Dict:
+        return {
+            "type": "file_begin",
+            "upload_id": self.upload_id,
+            "offset": self.received,
+            "next_chunk": self.next_chunk,
+            "max_chunk_size": UPLOAD_CHUNK_MAX_SIZE,
+        }
+
+
+def _append(path: str, data: memoryview, hasher) -> None:
+    with open(path, 'ab') as f:
+        f.write(data)
+    hasher.update(data)
+
+
+def remove_spool_file(path: str) -> None:
+    with suppress(FileNotFoundError):
+        os.remove(path)
+
+
+class UploadRegistry:
+    """Files sent as numbered binary chunks, spooled to disk as they arrive.
+
+    An interrupted upload can be resumed, also from a new connection, until it has been idle for `ttl` seconds.
+    Uploads live in this process and its spool directory: with several workers, a resumed upload has to reach
+    the worker it was started on, e.g. through sticky sessions, or it has to be started again.
+    Each user has at most `max_active` unfinished uploads reserving `max_spool` bytes in total.
+    """
+
+    def __init__(self, spool_dir: str = UPLOAD_SPOOL_DIR, ttl: float = UPLOAD_RESUME_TTL,
+                 max_chunk_size: int = UPLOAD_CHUNK_MAX_SIZE, max_active: int = UPLOAD_MAX_ACTIVE_PER_USER,
+                 max_spool: int = UPLOAD_MAX_SPOOL_PER_USER):
+        self.spool_dir = spool_dir
+        self.ttl = ttl
+        self.max_chunk_size = max_chunk_size
+        self.max_active = max_active
+        self.max_spool = max_spool
+        self.uploads: Dict[str, ChunkedUpload] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.task = asyncio.create_task(self._expire_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+
+    def begin(self, room_name: str, user_name: str, message_data: str, file_type: str, size: int,
+              upload_id: Optional[str] = None) -> ChunkedUpload:
+        if upload_id is not None:
+            upload = self.uploads.get(upload_id)
+            if upload is None or upload.user_name != user_name or upload.room_name != room_name:
+                raise UploadError("Upload not found, start it again.")
+            upload.last_activity = time.monotonic()
+            return upload
+        if not isinstance(file_type, str) or file_type not in SUPPORTED_FILE_TYPES_FORM_MESSAGE:
+            raise UploadError(f"Unsupported file type: {file_type}.")
+        max_size = max_file_size(file_type)
+        if size <= 0 or size > max_size:
+            raise UploadError(f"{file_type} file size exceeds the maximum allowed one of {max_size / MB} MB.")
+        active = [u for u in self.uploads.values() if u.user_name == user_name]
+        if len(active) >= self.max_active:
+            raise UploadError(f"At most {self.max_active} uploads can be in progress, finish or cancel one first.")
+        if sum(u.size for u in active) + size > self.max_spool:
+            raise UploadError(f"Uploads in progress may not exceed {self.max_spool / MB} MB in total.")
+        upload = ChunkedUpload(room_name, user_name, message_data, file_type, size, self.spool_dir)
+        self.uploads[upload.upload_id] = upload
+        return upload
+
+    async def write(self, upload_id: str, chunk_number: int, data: memoryview, user_name: str) -> ChunkedUpload:
+        upload = self.uploads.get(upload_id)
+        if upload is None or upload.user_name != user_name:
+            raise UploadError("Upload not found, start it again.")
+        async with upload.lock:
+            upload.last_activity = time.monotonic()
+            if chunk_number < upload.next_chunk:
+                # resent after a reconnect, already on disk
+                return upload
+            if chunk_number > upload.next_chunk:
+                raise UploadError(f"Expected chunk {upload.next_chunk}.", upload.received)
+            if len(data) > self.max_chunk_size or upload.received + len(data) > upload.size:
+                raise UploadError("Chunk exceeds the announced size.", upload.received)
+            if chunk_number == 0:
+                # the first chunk carries the file header: reject a mislabelled file before taking the rest
+                try:
+                    check_mime(upload.file_type, sniff_mime(bytes(data[:SNIFF_SIZE])))
+                except MediaMismatch as e:
+                    await self._discard(upload)
+                    raise UploadError(str(e))
+            await asyncio.get_running_loop().run_in_executor(None, _append, upload.path, data, upload.hasher)
+            upload.received += len(data)
+            upload.next_chunk += 1
+        return upload
+
+    async def commit(self, upload_id: str, user_name: str) -> ChunkedUpload:
+        """Hand the complete spool file over to the caller, who removes it when done."""
+        upload = self.uploads.get(upload_id)
+        if upload is None or upload.user_name != user_name:
+            raise UploadError("Upload not found, start it again.")
+        async with upload.lock:
+            if upload.received != upload.size:
+                raise UploadError(f"Received {upload.received} of {upload.size} bytes.", upload.received)
+            del self.uploads[upload_id]
+        return upload
+
+    async def cancel(self, upload_id: str, user_name: str):
+        upload = self.uploads.get(upload_id)
+        if upload is None or upload.user_name != user_name:
+            return
+        await self._discard(upload)
+
+    async def _discard(self, upload: ChunkedUpload):
+        self.uploads.pop(upload.upload_id, None)
+        await asyncio.get_running_loop().run_in_executor(None, remove_spool_file, upload.path)
+
+    async def _expire_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 2)
+            deadline = time.monotonic() - self.ttl
+            for upload in [u for u in self.uploads.values() if u.last_activity < deadline]:
+                logger.warning(f"Discarding abandoned upload {upload.upload_id} of {upload.user_name}")
+                try:
+                    await self._discard(upload)
+                except Exception as e:
+                    logger.error(f"Error removing spool file {upload.path}: {type(e)} {e}")
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from aws.schemas import FileRead
+from config import MESSAGE_BATCH_SIZE, MESSAGE_FLUSH_INTERVAL, MESSAGE_QUEUE_SIZE, MESSAGE_FLUSH_RETRIES, \
+    MESSAGE_ID_BLOCK_SIZE
+from database import async_session_maker
+from identity import resolve_room_ids, resolve_user_ids, invalidate_room, invalidate_user
+from message.recent import RecentMessages, recent_messages
+from message.schemas import MessageRead
+from models.models import message
+from user.schemas import UserReadRequest
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_ID_SEQUENCE = "message_message_id_seq"
+
+
+class PendingMessage:
+    __slots__ = ("message_id", "room_name", "user_name", "message_data", "media_file", "creation_date")
+
+    def __init__(self, message_id: int, room_name: str, user_name: str, message_data: str,
+                 media_file: Optional[FileRead] = None):
+        self.message_id = message_id
+        self.room_name = room_name
+        self.user_name = user_name
+        self.message_data = message_data
+        self.media_file = media_file
+        self.creation_date = datetime.utcnow()
+
+    def as_message(self, author: UserReadRequest) -> MessageRead:
+        media_file = self.media_file
+        return MessageRead(
+            message_id=self.message_id,
+            message=self.message_data,
+            media_file_url=media_file.file_name if media_file else None,
+            media_variants=media_file.variants if media_file else None,
+            media_width=media_file.width if media_file else None,
+            media_height=media_file.height if media_file else None,
+            media_duration=media_file.duration if media_file else None,
+            creation_date=self.creation_date,
+            user=author,
+        )
+
+
+class MessageWriter:
+    """Accepts chat messages without touching the database and persists them in batched INSERTs."""
+
+    def __init__(self, batch_size: int = MESSAGE_BATCH_SIZE, flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+                 queue_size: int = MESSAGE_QUEUE_SIZE, retries: int = MESSAGE_FLUSH_RETRIES,
+                 id_block_size: int = MESSAGE_ID_BLOCK_SIZE, recent: RecentMessages = recent_messages):
+        self.recent = recent
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.id_block_size = id_block_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.queue_size = queue_size
+        self.ids: List[int] = []
+        self.ids_lock: Optional[asyncio.Lock] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.ids_lock = asyncio.Lock()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        # the sentinel lets the flusher persist everything queued before it, then exit
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    async def submit(self, room_name: str, user_name: str, message_data: str,
+                     media_file: Optional[FileRead] = None, author: Optional[UserReadRequest] = None) -> PendingMessage:
+        pending = PendingMessage(await self._next_id(), room_name, user_name, message_data, media_file)
+        if author is not None:
+            self.recent.append(room_name, pending.as_message(author))
+        else:
+            # without the author the message can't be added to the room's tail, which would then have a gap
+            self.recent.invalidate(room_name)
+        # blocks the sender when the database falls behind instead of growing without bound
+        await self.queue.put(pending)
+        return pending
+
+    async def _next_id(self) -> int:
+        # ids come from the table's own sequence, reserved a block per round-trip
+        async with self.ids_lock:
+            if not self.ids:
+                async with async_session_maker() as session:
+                    result = await session.execute(
+                        select(func.nextval(MESSAGE_ID_SEQUENCE))
+                        .select_from(func.generate_series(1, self.id_block_size))
+                    )
+                    self.ids = sorted((row[0] for row in result.fetchall()), reverse=True)
+            return self.ids.pop()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = 0.0
+            while len(batch) < self.batch_size:
+                if batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        pending = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    pending = await self.queue.get()
+                    deadline = loop.time() + self.flush_interval
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[PendingMessage]):
+        if not batch:
+            return
+        try:
+            await self._persist(batch)
+        finally:
+            self.recent.settled((pending.room_name, pending.message_id) for pending in batch)
+
+    async def _persist(self, batch: List[PendingMessage]):
+        delay = self.flush_interval
+        for attempt in range(1, self.retries + 1):
+            try:
+                async with async_session_maker() as session:
+                    await self._insert(session, batch)
+                return
+            except Exception as e:
+                logger.error(f"Error flushing {len(batch)} messages to DB (attempt {attempt}): {type(e)} {e}")
+                # a room or user deleted elsewhere may have left a stale id in the cache
+                for pending in batch:
+                    invalidate_room(pending.room_name)
+                    invalidate_user(pending.user_name)
+                await asyncio.sleep(delay)
+                delay *= 2
+        # keep the rows that can be written when one of them keeps failing the batch
+        for pending in batch:
+            try:
+                async with async_session_maker() as session:
+                    await self._insert(session, [pending])
+            except Exception as e:
+                logger.error(f"Dropping message {pending.message_id} for room {pending.room_name}: {type(e)} {e}")
+
+    async def _insert(self, session: AsyncSession, batch: List[PendingMessage]):
+        room_ids = await resolve_room_ids(session, (p.room_name for p in batch))
+        user_ids = await resolve_user_ids(session, (p.user_name for p in batch))
+        rows = []
+        for pending in batch:
+            if pending.room_name not in room_ids or pending.user_name not in user_ids:
+                logger.error(f"Dropping message {pending.message_id}: unknown room {pending.room_name} "
+                             f"or user {pending.user_name}")
+                continue
+            media_file = pending.media_file
+            rows.append(dict(
+                message_id=pending.message_id,
+                message_data=pending.message_data,
+                media_file_url=media_file.file_name if media_file else None,
+                media_variants=media_file.variants if media_file else None,
+                media_width=media_file.width if media_file else None,
+                media_height=media_file.height if media_file else None,
+                media_duration=media_file.duration if media_file else None,
+                creation_date=pending.creation_date,
+                user=user_ids[pending.user_name],
+                room=room_ids[pending.room_name],
+            ))
+        if rows:
+            await session.execute(insert(message).values(rows))
+        await session.commit()
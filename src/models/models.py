@@ -1,7 +1,7 @@
 from datetime import datetime
 
 from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, Index, ForeignKeyConstraint, Boolean, \
-    UniqueConstraint
+    UniqueConstraint, JSON, BigInteger, Float, text
 
 from src.database import metadata
 
@@ -11,7 +11,10 @@ room = Table(
     Column("room_id", Integer, primary_key=True, autoincrement=True),
     Column("room_name", String(40), unique=True, nullable=False),
     Column("is_active", Boolean, default=False, nullable=False),
-    Column("creation_date", DateTime, default=datetime.utcnow, nullable=False)
+    Column("creation_date", DateTime, default=datetime.utcnow, nullable=False),
+    Index("idx_room__room_name_trgm", "room_name", postgresql_using="gin",
+          postgresql_ops={"room_name": "gin_trgm_ops"}),
+    Index("idx_room__room_name_prefix", text("lower(room_name) text_pattern_ops"))
 )
 
 user = Table(
@@ -54,11 +57,30 @@ message = Table(
     Column("message_id", Integer, primary_key=True, autoincrement=True),
     Column("message_data", String(4096), nullable=False),
     Column("media_file_url", String),
+    Column("media_variants", JSON, nullable=True),
+    Column("media_width", Integer, nullable=True),
+    Column("media_height", Integer, nullable=True),
+    Column("media_duration", Float, nullable=True),
     Column("creation_date", DateTime, nullable=False, default=datetime.utcnow),
     Column("user", Integer, nullable=False),
     Column("room", Integer, nullable=False),
-    Index("idx_message__room", "room"),
+    Index("idx_message__room_creation", "room", "creation_date", "message_id"),
     Index("idx_message__user", "user"),
     ForeignKeyConstraint(["room"], [room.c.room_id], ondelete="CASCADE"),
     ForeignKeyConstraint(["user"], [user.c.id], ondelete="CASCADE")
 )
+
+media_object = Table(
+    "media_object",
+    metadata,
+    # sha256 of the uploaded bytes, before any compression or transcoding
+    Column("content_hash", String(64), primary_key=True),
+    Column("file_type", String(100), nullable=False),
+    Column("object_key", String, nullable=False),
+    Column("size", BigInteger, nullable=False),
+    Column("variants", JSON, nullable=True),
+    Column("width", Integer, nullable=True),
+    Column("height", Integer, nullable=True),
+    Column("duration", Float, nullable=True),
+    Column("creation_date", DateTime, default=datetime.utcnow, nullable=False)
+)
@@ -0,0 +1,55 @@
+from fastapi import APIRouter, Depends
+
+import identity
+from auth.base_config import fastapi_users
+from aws.workers import image_workers, video_workers
+from database import get_pool_stats
+from message.recent import recent_messages
+from message.router import media_jobs
+from presence import presence
+
+router = APIRouter(dependencies=[Depends(fastapi_users.current_user(superuser=True))])
+
+
+@router.get("/identity-cache")
+async def get_identity_cache_stats():
+    """
+    Get hit/miss counters of the username/room name -> id cache
+    """
+    return identity.stats()
+
+
+@router.get("/db-pool")
+async def get_db_pool_stats():
+    """
+    Get checked-out/idle connections and checkout wait times of the DB pool
+    """
+    return get_pool_stats()
+
+
+@router.get("/workers")
+async def get_worker_stats():
+    """
+    Get queue depth, rejections and timeouts of the media worker pools and job queue
+    """
+    return {
+        "image": image_workers.stats(),
+        "video": video_workers.stats(),
+        "media_jobs": media_jobs.stats(),
+    }
+
+
+@router.get("/recent-messages")
+async def get_recent_messages_stats():
+    """
+    Get size and hit/miss counters of the per-room recent message tails
+    """
+    return recent_messages.stats()
+
+
+@router.get("/presence")
+async def get_presence_stats():
+    """
+    Get tracked rooms/users and is_active updates waiting to be written
+    """
+    return presence.stats()
@@ -0,0 +1,24 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, List
+
+
+def encode_cursor(*values: Any) -> str:
+    raw = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        raise ValueError("Malformed pagination cursor")
+    if not isinstance(values, list):
+        raise ValueError("Malformed pagination cursor")
+    return values
+
+
+def clamp_limit(limit: int, max_limit: int) -> int:
+    return max(1, min(limit, max_limit))
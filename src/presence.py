@@ -0,0 +1,340 @@
+import asyncio
+import logging
+import time
+from contextlib import suppress
+from typing import Any, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from sqlalchemy import update, tuple_
+
+from config import PRESENCE_FLUSH_INTERVAL, PRESENCE_SYNC_INTERVAL, PRESENCE_PEER_TTL
+from database import async_session_maker
+from identity import resolve_room_ids, resolve_user_ids
+from message import codec
+from message.backplane import Backplane
+from models.models import room, room_user
+
+logger = logging.getLogger(__name__)
+
+# backplane control messages carrying presence
+PRESENCE_KIND = "presence"
+
+
+class PresenceView:
+    """Memberships seen on one worker: which users have sockets in which rooms."""
+
+    def __init__(self):
+        # room_name -> user_name -> open sockets of that user in the room
+        self.rooms: Dict[str, Dict[str, int]] = {}
+        # user_name -> rooms the user has a socket in
+        self.users: Dict[str, Set[str]] = {}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, List[str]]) -> "PresenceView":
+        view = cls()
+        for room_name, user_names in state.items():
+            for user_name in user_names:
+                view.join(room_name, user_name)
+        return view
+
+    def join(self, room_name: str, user_name: str) -> bool:
+        """True if the user wasn't in the room before"""
+        members = self.rooms.setdefault(room_name, {})
+        first = user_name not in members
+        if first:
+            members[user_name] = 0
+            self.users.setdefault(user_name, set()).add(room_name)
+        members[user_name] += 1
+        return first
+
+    def leave(self, room_name: str, user_name: str, all_sockets: bool = False) -> bool:
+        """True if the user is no longer in the room"""
+        members = self.rooms.get(room_name)
+        if members is None or user_name not in members:
+            return False
+        members[user_name] -= 1
+        if members[user_name] > 0 and not all_sockets:
+            return False
+        del members[user_name]
+        user_rooms = self.users.get(user_name)
+        if user_rooms is not None:
+            user_rooms.discard(room_name)
+            if not user_rooms:
+                del self.users[user_name]
+        if not members:
+            del self.rooms[room_name]
+        return True
+
+    def has_member(self, room_name: str, user_name: str) -> bool:
+        return user_name in self.rooms.get(room_name, ())
+
+    def memberships(self) -> Set[Tuple[str, str]]:
+        return {(room_name, user_name) for room_name, members in self.rooms.items() for user_name in members}
+
+    def state(self) -> Dict[str, List[str]]:
+        return {room_name: list(members) for room_name, members in self.rooms.items()}
+
+
+class PresenceTracker:
+    """Who is connected to which room across all workers, kept in memory and mirrored to the is_active columns.
+
+    Each worker tracks its own sockets and relays joins and leaves over the backplane, plus its whole state every
+    `sync_interval` seconds; a worker that stays silent for `peer_ttl` seconds is forgotten. Queries answer from
+    the merged view of all workers. The unix backplane carries at most 64 KB of state per worker.
+
+    Only the worker with the lowest node id writes the flags. When it takes over it rewrites all of them from the
+    merged view once; after that, every `flush_interval` seconds, it writes the latest state of each changed room
+    and membership with one UPDATE per table and state, so a reconnect within the interval writes nothing.
+    """
+
+    def __init__(self, flush_interval: float = PRESENCE_FLUSH_INTERVAL, sync_interval: float = PRESENCE_SYNC_INTERVAL,
+                 peer_ttl: float = PRESENCE_PEER_TTL):
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self.peer_ttl = peer_ttl
+        self.node_id = uuid4().hex
+        self.backplane: Optional[Backplane] = None
+        self.local = PresenceView()
+        # node id -> that worker's memberships and when it was last heard from
+        self.peers: Dict[str, PresenceView] = {}
+        self.peer_seen: Dict[str, float] = {}
+        # whether this worker writes the flags and the database matches persisted_* plus dirty_*
+        self.writer = False
+        # state still to be written; keys already written as active are kept in the persisted sets
+        self.dirty_rooms: Dict[str, bool] = {}
+        self.dirty_members: Dict[Tuple[str, str], bool] = {}
+        self.persisted_rooms: Set[str] = set()
+        self.persisted_members: Set[Tuple[str, str]] = set()
+        self.flushes = 0
+        self.reconciles = 0
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self, backplane: Optional[Backplane] = None):
+        if backplane is not None:
+            self.backplane = backplane
+            self.node_id = backplane.node_id
+            backplane.on_control(PRESENCE_KIND, self._on_message)
+            # the other workers answer with their state
+            await self._publish({"op": "sync"})
+        self.task = asyncio.create_task(self._tick_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+        # sockets still open are going away with the process
+        memberships = self.local.memberships()
+        self.local = PresenceView()
+        for room_name, user_name in memberships:
+            self._changed(room_name, user_name)
+        await self._publish({"op": "bye"})
+        if self.writer:
+            await self.flush()
+
+    async def join(self, room_name: str, user_name: str) -> None:
+        if self.local.join(room_name, user_name):
+            self._changed(room_name, user_name)
+            await self._publish({"op": "set", "room": room_name, "user": user_name, "online": True})
+
+    async def leave(self, room_name: str, user_name: str) -> None:
+        if self.local.leave(room_name, user_name):
+            self._changed(room_name, user_name)
+            await self._publish({"op": "set", "room": room_name, "user": user_name, "online": False})
+
+    def _views(self) -> List[PresenceView]:
+        return [self.local, *self.peers.values()]
+
+    def is_room_active(self, room_name: str) -> bool:
+        return any(room_name in view.rooms for view in self._views())
+
+    def room_members(self, room_name: str) -> List[str]:
+        return sorted(set().union(*(view.rooms.get(room_name, ()) for view in self._views())))
+
+    def user_rooms(self, user_name: str) -> List[str]:
+        return sorted(set().union(*(view.users.get(user_name, ()) for view in self._views())))
+
+    def _changed(self, room_name: str, user_name: str):
+        views = self._views()
+        self._mark_member(room_name, user_name, any(view.has_member(room_name, user_name) for view in views))
+        self._mark_room(room_name, any(room_name in view.rooms for view in views))
+
+    def _mark_room(self, room_name: str, is_active: bool):
+        if is_active == (room_name in self.persisted_rooms):
+            # back to what the database already holds
+            self.dirty_rooms.pop(room_name, None)
+        else:
+            self.dirty_rooms[room_name] = is_active
+
+    def _mark_member(self, room_name: str, user_name: str, is_active: bool):
+        key = (room_name, user_name)
+        if is_active == (key in self.persisted_members):
+            self.dirty_members.pop(key, None)
+        else:
+            self.dirty_members[key] = is_active
+
+    async def _publish(self, message: Dict[str, Any]):
+        if self.backplane is None:
+            return
+        try:
+            await self.backplane.publish_control(PRESENCE_KIND, codec.dumps(message))
+        except Exception as e:
+            # the next state sync repairs the other workers' view
+            logger.error(f"Error relaying presence to other workers: {type(e)} {e}")
+
+    async def _on_message(self, origin: str, payload: bytes):
+        message = codec.loads(payload)
+        op = message.get("op")
+        if op == "bye":
+            self._drop_peer(origin)
+            return
+        self.peer_seen[origin] = time.monotonic()
+        view = self.peers.setdefault(origin, PresenceView())
+        if op == "set":
+            room_name, user_name = message["room"], message["user"]
+            if message["online"]:
+                changed = view.join(room_name, user_name)
+            else:
+                changed = view.leave(room_name, user_name, all_sockets=True)
+            if changed:
+                self._changed(room_name, user_name)
+        elif op == "state":
+            state = PresenceView.from_state(message["rooms"])
+            self.peers[origin] = state
+            for room_name, user_name in view.memberships() ^ state.memberships():
+                self._changed(room_name, user_name)
+        elif op == "sync":
+            await self._publish({"op": "state", "rooms": self.local.state()})
+
+    def _drop_peer(self, node_id: str):
+        self.peer_seen.pop(node_id, None)
+        view = self.peers.pop(node_id, None)
+        if view is None:
+            return
+        for room_name, user_name in view.memberships():
+            self._changed(room_name, user_name)
+
+    async def _tick_loop(self):
+        last_sync = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                now = time.monotonic()
+                for node_id in [n for n, seen in self.peer_seen.items() if seen < now - self.peer_ttl]:
+                    logger.warning(f"Forgetting presence of worker {node_id}, not heard from in {self.peer_ttl}s")
+                    self._drop_peer(node_id)
+                if now - last_sync >= self.sync_interval:
+                    last_sync = now
+                    await self._publish({"op": "state", "rooms": self.local.state()})
+                await self._write()
+            except Exception as e:
+                logger.error(f"Error in presence tick: {type(e)} {e}")
+
+    async def _write(self):
+        if self.node_id != min([self.node_id, *self.peers]):
+            # another worker writes the flags
+            self.writer = False
+            self.dirty_rooms.clear()
+            self.dirty_members.clear()
+            return
+        if not self.writer:
+            self.writer = await self._reconcile()
+            return
+        await self.flush()
+
+    async def _reconcile(self) -> bool:
+        """Make every flag match the merged view, whatever the database held; scans both tables, once per takeover"""
+        views = self._views()
+        rooms = set().union(*(view.rooms for view in views))
+        members = set().union(*(view.memberships() for view in views))
+        try:
+            async with async_session_maker() as session:
+                room_active = room.c.room_name.in_(rooms)
+                await session.execute(
+                    update(room).where(room.c.is_active != room_active).values(is_active=room_active)
+                )
+                room_ids = await resolve_room_ids(session, (room_name for room_name, _ in members))
+                user_ids = await resolve_user_ids(session, (user_name for _, user_name in members))
+                pairs = [(user_ids[user_name], room_ids[room_name]) for room_name, user_name in members
+                         if room_name in room_ids and user_name in user_ids]
+                member_active = tuple_(room_user.c.user, room_user.c.room).in_(pairs)
+                await session.execute(
+                    update(room_user).where(room_user.c.is_active != member_active).values(is_active=member_active)
+                )
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Error writing presence of {len(rooms)} rooms and {len(members)} members: {type(e)} {e}")
+            return False
+        self.reconciles += 1
+        self.persisted_rooms = rooms
+        self.persisted_members = members
+        self.dirty_rooms.clear()
+        self.dirty_members.clear()
+        # joins and leaves made while the UPDATEs ran
+        for room_name, user_name in members | set().union(*(view.memberships() for view in self._views())):
+            self._changed(room_name, user_name)
+        return True
+
+    async def flush(self):
+        if not self.dirty_rooms and not self.dirty_members:
+            return
+        rooms, self.dirty_rooms = self.dirty_rooms, {}
+        members, self.dirty_members = self.dirty_members, {}
+        try:
+            async with async_session_maker() as session:
+                for is_active in (True, False):
+                    room_names = [name for name, state in rooms.items() if state == is_active]
+                    if room_names:
+                        await session.execute(
+                            update(room).where(room.c.room_name.in_(room_names)).values(is_active=is_active)
+                        )
+                room_ids = await resolve_room_ids(session, (room_name for room_name, _ in members))
+                user_ids = await resolve_user_ids(session, (user_name for _, user_name in members))
+                for is_active in (True, False):
+                    pairs = [(user_ids[user_name], room_ids[room_name])
+                             for (room_name, user_name), state in members.items()
+                             if state == is_active and room_name in room_ids and user_name in user_ids]
+                    if pairs:
+                        await session.execute(
+                            update(room_user)
+                            .where(tuple_(room_user.c.user, room_user.c.room).in_(pairs))
+                            .values(is_active=is_active)
+                        )
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Error flushing presence of {len(rooms)} rooms and {len(members)} members: "
+                         f"{type(e)} {e}")
+        else:
+            self.flushes += 1
+            for room_name, state in rooms.items():
+                if state:
+                    self.persisted_rooms.add(room_name)
+                else:
+                    self.persisted_rooms.discard(room_name)
+            for key, state in members.items():
+                if state:
+                    self.persisted_members.add(key)
+                else:
+                    self.persisted_members.discard(key)
+        # what is still to be written is the current state wherever it differs from the database; this also
+        # retries a failed flush and catches joins and leaves made while the UPDATEs ran
+        for room_name, user_name in members:
+            self._changed(room_name, user_name)
+        for room_name in rooms:
+            self._mark_room(room_name, self.is_room_active(room_name))
+
+    def stats(self):
+        return {
+            "rooms": len(self.local.rooms),
+            "users": len(self.local.users),
+            "peers": len(self.peers),
+            "writer": self.writer,
+            "pending_rooms": len(self.dirty_rooms),
+            "pending_members": len(self.dirty_members),
+            "flushes": self.flushes,
+            "reconciles": self.reconciles,
+        }
+
+
+presence = PresenceTracker()
@@ -2,25 +2,35 @@ import logging
 from datetime import datetime
 from typing import Optional, List
 
-from sqlalchemy import select, insert, delete, and_, update
+from sqlalchemy import select, insert, delete, and_, update, func, false, literal, tuple_
 from sqlalchemy.exc import NoResultFound, MultipleResultsFound, IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from message.crud import get_messages_in_room
-from models.models import room, user, room_user, message
-from room.schemas import RoomReadRequest, RoomBaseInfoForUserRequest, FavoriteRequest, RoomBaseInfoForAllUserRequest
-from user.crud import get_users_in_room
+import identity
+from config import ROOM_PAGE_SIZE, ROOM_PAGE_MAX_SIZE, ROOM_SNAPSHOT_MESSAGES, ROOM_SNAPSHOT_MEMBERS
+from identity import resolve_room_id, resolve_user_id
+from message.crud import get_messages_in_room, get_recent_messages
+from message.recent import recent_messages
+from message.schemas import MessageRead
+from models.models import room, room_user, message
+from pagination import clamp_limit, decode_cursor, encode_cursor
+from presence import presence
+from room.schemas import RoomReadRequest, RoomBaseInfoForUserRequest, FavoriteRequest, RoomBaseInfoForAllUserRequest, \
+    RoomPage, FavoriteRoomPage, RoomSnapshot
+from user.crud import get_users_in_room, get_member_summary
 
 logger = logging.getLogger(__name__)
 
 
 async def insert_room(session: AsyncSession, username: str, room_name: str) -> RoomReadRequest:
     try:
-        await session.execute(insert(room).values(room_name=room_name))
-        user_instance = (await session.execute(select(user).filter_by(username=username))).scalar_one()
-        room_instance = (await session.execute(select(room).filter_by(room_name=room_name))).scalar_one()
+        room_instance = (await session.execute(
+            insert(room).values(room_name=room_name).returning(room.c.room_id)
+        )).scalar_one()
+        user_instance = await resolve_user_id(session, username)
         await session.execute(insert(room_user).values(user=user_instance, room=room_instance, is_owner=True))
         await session.commit()
+        identity.room_ids.set(room_name, room_instance)
         return await get_room(session, room_name)
     except IntegrityError as e:
         logger.error(f"IntegrityError: {e}")
@@ -40,6 +50,8 @@ async def delete_room(session: AsyncSession, room_name: str) -> None:
         await session.execute(delete(room_user).filter_by(room=room_id))
         await session.execute(delete(message).filter_by(room=room_id))
         await session.commit()
+        identity.invalidate_room(room_name)
+        recent_messages.drop(room_name)
     except Exception as e:
         logger.error(f"Error deleting room: {e}")
         await session.rollback()
@@ -50,14 +62,14 @@ async def get_room(session: AsyncSession, room_name: str) -> Optional[RoomReadRe
         room_instance = (await session.execute(select(room).filter_by(room_name=room_name))).one()
         room_id = room_instance.room_id
         members = await get_users_in_room(session, room_id)
-        messages = await get_messages_in_room(session, room_id)
+        messages = await get_messages_in_room(session, room_id, room_instance.room_name)
         await session.commit()
         return RoomReadRequest(
             room_id=room_instance.room_id,
             room_name=room_instance.room_name,
             members=members,
             messages=messages,
-            room_active=room_instance.is_active,
+            room_active=presence.is_room_active(room_name) or room_instance.is_active,
             room_creation_date=room_instance.creation_date
         )
     except Exception as e:
@@ -65,39 +77,92 @@ async def get_room(session: AsyncSession, room_name: str) -> Optional[RoomReadRe
         return None
 
 
-async def filter_rooms(session: AsyncSession, current_user_id: int, room_name: str, page: int = 1, limit: int = 10) \
-        -> Optional[List[RoomBaseInfoForUserRequest]]:
+def _room_version(messages: List[MessageRead]) -> Optional[str]:
+    # ids are reserved in blocks per worker and don't order messages, (creation_date, id) does
+    if not messages:
+        return None
+    newest = max(messages, key=lambda m: (m.creation_date, m.message_id))
+    return encode_cursor(newest.creation_date, newest.message_id)
+
+
+async def get_room_snapshot(session: AsyncSession, room_name: str, message_limit: int = ROOM_SNAPSHOT_MESSAGES,
+                            member_limit: int = ROOM_SNAPSHOT_MEMBERS) -> Optional[RoomSnapshot]:
+    """
+    What a client joining the room needs: the newest messages and a member summary, both bounded
+    """
     try:
-        query = await session.execute(
-            select(
-                room.c.room_id,
-                room.c.room_name,
-                room_user.c.is_chosen,
-                room_user.c.creation_date
-            )
-            .join(room_user, and_(room.c.room_id == room_user.c.room, room_user.c.user == current_user_id),
-                  isouter=True)
-            .filter(room.c.room_name.ilike(f'%{room_name}%'))
-            .order_by(
-                room_user.c.update_date.desc(),
-                room_user.c.is_chosen.desc()
-            )
-            .limit(limit)
-            .offset((page - 1) * limit)
+        room_instance = (await session.execute(select(room).filter_by(room_name=room_name))).one()
+        room_id = room_instance.room_id
+        member_count, members = await get_member_summary(session, room_id, member_limit)
+        page = await get_recent_messages(session, room_id, room_instance.room_name, message_limit)
+        await session.commit()
+        return RoomSnapshot(
+            room_id=room_id,
+            room_name=room_instance.room_name,
+            room_active=presence.is_room_active(room_name) or room_instance.is_active,
+            room_creation_date=room_instance.creation_date,
+            room_version=_room_version(page.messages),
+            member_count=member_count,
+            members=members,
+            messages=page.messages,
+            older_cursor=page.older_cursor,
+        )
+    except Exception as e:
+        logger.error(f"Error getting room snapshot: {e}")
+        return None
+
+
+def _user_rooms_sort_key(favorite_only: bool = False):
+    # (favorite, update_date, room_id), all descending; rooms the user never touched sort by creation date
+    favorite = room_user.c.is_chosen if favorite_only else func.coalesce(room_user.c.is_chosen, false())
+    updated = func.coalesce(room_user.c.update_date, room_user.c.creation_date, room.c.creation_date)
+    return favorite.label("sort_favorite"), updated.label("sort_updated"), room.c.room_id.label("sort_room_id")
+
+
+def _keyset_page(query, sort_key, cursor: Optional[str], limit: int):
+    if cursor is not None:
+        favorite, updated, room_id = decode_cursor(cursor)
+        bound = (literal(bool(favorite)), literal(datetime.fromisoformat(updated)), literal(int(room_id)))
+        query = query.where(tuple_(*(column.element for column in sort_key)) < tuple_(*bound))
+    return query.order_by(*(column.element.desc() for column in sort_key)).limit(limit + 1)
+
+
+def _next_cursor(rows, limit: int) -> Optional[str]:
+    if len(rows) <= limit:
+        return None
+    last = rows[limit - 1]
+    return encode_cursor(last.sort_favorite, last.sort_updated, last.sort_room_id)
+
+
+async def filter_rooms(session: AsyncSession, current_user_id: int, room_name: str, cursor: Optional[str] = None,
+                      limit: int = ROOM_PAGE_SIZE) -> Optional[RoomPage]:
+    limit = clamp_limit(limit, ROOM_PAGE_MAX_SIZE)
+    sort_key = _user_rooms_sort_key()
+    query = _keyset_page(
+        select(
+            room.c.room_id,
+            room.c.room_name,
+            room_user.c.is_chosen,
+            *sort_key
         )
+        .join(room_user, and_(room.c.room_id == room_user.c.room, room_user.c.user == current_user_id),
+              isouter=True)
+        .filter(room.c.room_name.ilike(f'%{room_name}%')),
+        sort_key, cursor, limit
+    )
+    try:
+        rows = (await session.execute(query)).fetchall()
         rooms: List[RoomBaseInfoForUserRequest] = list()
-        rows = query.fetchall()
-        for row in rows:
+        for row in rows[:limit]:
             rooms.append(
                 RoomBaseInfoForUserRequest(
-                    room_id=row[0],
-                    room_name=row[1],
-                    is_favorites=row[2] if row[2] is not None else False
+                    room_id=row.room_id,
+                    room_name=row.room_name,
+                    is_favorites=row.is_chosen if row.is_chosen is not None else False
                 )
             )
-        rooms.sort(key=lambda x: x.is_favorites, reverse=True)
         await session.commit()
-        return rooms
+        return RoomPage(rooms=rooms, next_cursor=_next_cursor(rows, limit))
     except Exception as e:
         logger.error(f"Error filtering rooms: {e}")
         return None
@@ -105,8 +170,8 @@ async def filter_rooms(session: AsyncSession, current_user_id: int, room_name: s
 
 async def add_user_to_room(session: AsyncSession, username: str, room_name: str):
     try:
-        user_instance = (await session.execute(select(user).filter_by(username=username))).scalar_one()
-        room_instance = (await session.execute(select(room).filter_by(room_name=room_name))).scalar_one()
+        user_instance = await resolve_user_id(session, username)
+        room_instance = await resolve_room_id(session, room_name)
         entity_room_user = (await session.execute(
             select(room_user)
             .where(and_(room_user.c.user == user_instance, room_user.c.room == room_instance))
@@ -124,126 +189,105 @@ async def add_user_to_room(session: AsyncSession, username: str, room_name: str)
         return None
 
 
-async def set_user_room_activity(session: AsyncSession, username: str, room_name: str, is_active: bool):
-    try:
-        room_instance = (await session.execute(select(room).filter_by(room_name=room_name))).scalar_one()
-        user_instance = (await session.execute(select(user).filter_by(username=username))).scalar_one()
-        await session.execute(
-            update(room_user).where(
-                and_(room_user.c.user == user_instance, room_user.c.room == room_instance)
-            ).values(is_active=is_active)
+async def get_rooms(session: AsyncSession, current_user_id: int, cursor: Optional[str] = None,
+                   limit: int = ROOM_PAGE_SIZE) -> Optional[RoomPage]:
+    limit = clamp_limit(limit, ROOM_PAGE_MAX_SIZE)
+    sort_key = _user_rooms_sort_key()
+    query = _keyset_page(
+        select(
+            room.c.room_id,
+            room.c.room_name,
+            room_user.c.is_chosen,
+            *sort_key
         )
-        await session.commit()
-        return True
-    except Exception as e:
-        logger.error(f"Error removing user from room: {e}")
-        await session.rollback()
-        return False
-
-
-async def set_room_activity(session: AsyncSession, room_name: str, activity_bool: bool):
+        .join(room_user, and_(room.c.room_id == room_user.c.room, room_user.c.user == current_user_id),
+              isouter=True),
+        sort_key, cursor, limit
+    )
     try:
-        await session.execute(update(room).where(room.c.room_name == room_name).values(is_active=activity_bool))
-        room_instance = (await session.execute(select(room).filter_by(room_name=room_name))).one()
-        await session.commit()
-        return room_instance
-    except Exception as e:
-        logger.error(f"Error setting room activity: {e}")
-        await session.rollback()
-        return None
-
-
-async def get_rooms(session: AsyncSession, current_user_id: int, page: int = 1, limit: int = 10) \
-        -> Optional[List[RoomBaseInfoForUserRequest]]:
-    try:
-        query = await session.execute(
-            select(
-                room.c.room_id,
-                room.c.room_name,
-                room_user.c.is_chosen,
-                room_user.c.creation_date
-            )
-            .join(room_user, and_(room.c.room_id == room_user.c.room, room_user.c.user == current_user_id),
-                  isouter=True)
-            .order_by(
-                room_user.c.update_date.desc(),
-                room_user.c.is_chosen.desc()
-            )
-            .limit(limit)
-            .offset((page - 1) * limit)
-        )
+        rows = (await session.execute(query)).fetchall()
         rooms: List[RoomBaseInfoForUserRequest] = list()
-        rows = query.fetchall()
-        for row in rows:
+        for row in rows[:limit]:
             rooms.append(
                 RoomBaseInfoForUserRequest(
-                    room_id=row[0],
-                    room_name=row[1],
-                    is_favorites=row[2] if row[2] is not None else False
+                    room_id=row.room_id,
+                    room_name=row.room_name,
+                    is_favorites=row.is_chosen if row.is_chosen is not None else False
                 )
             )
-        rooms.sort(key=lambda x: x.is_favorites, reverse=True)
         await session.commit()
-        return rooms
+        return RoomPage(rooms=rooms, next_cursor=_next_cursor(rows, limit))
     except Exception as e:
         logger.error(f"Error getting rooms: {e}")
         return None
 
 
-async def get_user_favorite(session: AsyncSession, current_user_id: int, page: int = 1, limit: int = 10) \
-        -> Optional[List[RoomBaseInfoForAllUserRequest]]:
+async def get_user_favorite(session: AsyncSession, current_user_id: int, cursor: Optional[str] = None,
+                           limit: int = ROOM_PAGE_SIZE) -> Optional[FavoriteRoomPage]:
+    limit = clamp_limit(limit, ROOM_PAGE_MAX_SIZE)
+    sort_key = _user_rooms_sort_key(favorite_only=True)
+    query = _keyset_page(
+        select(
+            room.c.room_id,
+            room.c.room_name,
+            room_user.c.is_chosen,
+            room_user.c.is_owner,
+            *sort_key
+        )
+        .join(room_user, and_(room.c.room_id == room_user.c.room, room_user.c.user == current_user_id,
+                              room_user.c.is_chosen == True)),
+        sort_key, cursor, limit
+    )
     try:
-        query = await (session.execute(
-            select(room, room_user)
-            .join(room_user, and_(room.c.room_id == room_user.c.room, room_user.c.user == current_user_id,
-                                  room_user.c.is_chosen == True))
-            .order_by(room_user.c.update_date.desc())
-            .limit(limit)
-            .offset((page - 1) * limit)
-        ))
-        rooms = list()
-        rows = query.fetchall()
-        for row in rows:
+        rows = (await session.execute(query)).fetchall()
+        rooms: List[RoomBaseInfoForAllUserRequest] = list()
+        for row in rows[:limit]:
             rooms.append(
                 RoomBaseInfoForAllUserRequest(
-                    room_id=row[0],
-                    room_name=row[1],
-                    is_favorites=row[6] if row[6] is not None else False,
-                    is_owner=row[8] if row[8] is not None else False
+                    room_id=row.room_id,
+                    room_name=row.room_name,
+                    is_favorites=row.is_chosen if row.is_chosen is not None else False,
+                    is_owner=row.is_owner if row.is_owner is not None else False
                 )
             )
         await session.commit()
-        return rooms
+        return FavoriteRoomPage(rooms=rooms, next_cursor=_next_cursor(rows, limit))
     except Exception as e:
         logger.error(f"Error getting rooms: {e}")
         return None
 
 
-async def get_user_favorite_like_room_name(session: AsyncSession, room_name: str, current_user_id: int, page: int = 1,
-                                           limit: int = 10) \
-        -> Optional[List[RoomBaseInfoForAllUserRequest]]:
+async def get_user_favorite_like_room_name(session: AsyncSession, room_name: str, current_user_id: int,
+                                          cursor: Optional[str] = None, limit: int = ROOM_PAGE_SIZE) \
+        -> Optional[FavoriteRoomPage]:
+    limit = clamp_limit(limit, ROOM_PAGE_MAX_SIZE)
+    sort_key = _user_rooms_sort_key(favorite_only=True)
+    query = _keyset_page(
+        select(
+            room.c.room_id,
+            room.c.room_name,
+            room_user.c.is_chosen,
+            room_user.c.is_owner,
+            *sort_key
+        )
+        .join(room_user, and_(room.c.room_id == room_user.c.room, room_user.c.user == current_user_id,
+                              room_user.c.is_chosen == True, room.c.room_name.ilike(f'%{room_name}%'))),
+        sort_key, cursor, limit
+    )
     try:
-        query = await (session.execute(
-            select(room, room_user)
-            .join(room_user, and_(room.c.room_id == room_user.c.room, room_user.c.user == current_user_id,
-                                  room_user.c.is_chosen == True, room.c.room_name.ilike(f'%{room_name}%')))
-            .order_by(room_user.c.update_date.desc())
-            .limit(limit)
-            .offset((page - 1) * limit)
-        ))
-        rooms = list()
-        rows = query.fetchall()
-        for row in rows:
+        rows = (await session.execute(query)).fetchall()
+        rooms: List[RoomBaseInfoForAllUserRequest] = list()
+        for row in rows[:limit]:
             rooms.append(
                 RoomBaseInfoForAllUserRequest(
-                    room_id=row[0],
-                    room_name=row[1],
-                    is_favorites=row[6] if row[6] is not None else False,
-                    is_owner=row[8] if row[8] is not None else False
+                    room_id=row.room_id,
+                    room_name=row.room_name,
+                    is_favorites=row.is_chosen if row.is_chosen is not None else False,
+                    is_owner=row.is_owner if row.is_owner is not None else False
                 )
             )
         await session.commit()
-        return rooms
+        return FavoriteRoomPage(rooms=rooms, next_cursor=_next_cursor(rows, limit))
     except Exception as e:
         logger.error(f"Error getting rooms: {e}")
         return None
@@ -251,7 +295,7 @@ async def get_user_favorite_like_room_name(session: AsyncSession, room_name: str
 
 async def alter_favorite(session: AsyncSession, current_user_id: int, request: FavoriteRequest) -> None:
     try:
-        room_instance = (await session.execute(select(room).filter_by(room_name=request.room_name))).scalar_one()
+        room_instance = await resolve_room_id(session, request.room_name)
         entity_room_user = (await session.execute(
             select(room_user)
             .where(and_(room_user.c.user == current_user_id, room_user.c.room == room_instance))
@@ -1,15 +1,25 @@
 import logging
 
+from typing import Optional
+
 from fastapi import APIRouter, Depends, Request, HTTPException, status
+from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.base_config import fastapi_users
 from auth.schemas import UserRead
+from config import MESSAGE_PAGE_SIZE, ROOM_PAGE_SIZE, AUTOCOMPLETE_MAX_SIZE
 from database import get_async_session
+from identity import resolve_room_id
+from message.crud import get_message_history
+from message.schemas import MessagePage
+from pagination import clamp_limit
+from presence import presence
 from ratelimiter import limiter
 from room.crud import insert_room, add_user_to_room, get_rooms, filter_rooms, get_room, delete_room, get_user_favorite, \
     get_user_favorite_like_room_name, alter_favorite
-from room.schemas import RoomCreateRequest, FavoriteRequest
+from room.schemas import RoomCreateRequest, FavoriteRequest, RoomPresence
+from room.search import complete_room_names
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -44,26 +54,43 @@ async def add_user_to_room_members(request: Request,
     return row
 
 
+def _bad_cursor() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Malformed pagination cursor.")
+
+
 @router.get("/rooms")
-async def get_all_rooms(page: int = 1, limit: int = 10,
+async def get_all_rooms(cursor: Optional[str] = None, limit: int = ROOM_PAGE_SIZE,
                         current_user: UserRead = Depends(fastapi_users.current_user()),
                         session: AsyncSession = Depends(get_async_session)):
     """
     Get all rooms
+    pass the returned next_cursor as "cursor" to get the next page
     """
-    rooms = await get_rooms(session, current_user.id, page, limit)
-    return rooms
+    try:
+        return await get_rooms(session, current_user.id, cursor, limit)
+    except (ValueError, TypeError):
+        raise _bad_cursor()
 
 
 @router.get("/rooms/{room_name}")
-async def filter_out_rooms(room_name: str, page: int = 1, limit: int = 10,
+async def filter_out_rooms(room_name: str, cursor: Optional[str] = None, limit: int = ROOM_PAGE_SIZE,
                            current_user: UserRead = Depends(fastapi_users.current_user()),
                            session: AsyncSession = Depends(get_async_session)):
     """
     Filter all rooms
     """
-    rooms = await filter_rooms(session, current_user.id, room_name, page, limit)
-    return rooms
+    try:
+        return await filter_rooms(session, current_user.id, room_name, cursor, limit)
+    except (ValueError, TypeError):
+        raise _bad_cursor()
+
+
+@router.get("/autocomplete/rooms", dependencies=[Depends(fastapi_users.current_user())])
+async def autocomplete_room_names(prefix: str, limit: int = 10, session: AsyncSession = Depends(get_async_session)):
+    """
+    Get room names starting with the prefix (case-insensitive)
+    """
+    return await complete_room_names(session, prefix, clamp_limit(limit, AUTOCOMPLETE_MAX_SIZE))
 
 
 @router.get("/room/{room_name}", dependencies=[Depends(fastapi_users.current_user())])
@@ -75,6 +102,36 @@ async def get_single_room(room_name: str, session: AsyncSession = Depends(get_as
     return selected_room
 
 
+@router.get("/room/{room_name}/messages", dependencies=[Depends(fastapi_users.current_user())],
+            response_model=MessagePage)
+async def get_room_messages(room_name: str, before: Optional[str] = None, after: Optional[str] = None,
+                            limit: int = MESSAGE_PAGE_SIZE, session: AsyncSession = Depends(get_async_session)):
+    """
+    Get a page of the room's message history
+    pass older_cursor as "before" or newer_cursor as "after" to move through the history
+    """
+    if before is not None and after is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pass either before or after, not both.")
+    try:
+        room_id = await resolve_room_id(session, room_name)
+    except NoResultFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found.")
+    try:
+        return await get_message_history(session, room_id, before, after, limit)
+    except (ValueError, TypeError):
+        raise _bad_cursor()
+
+
+@router.get("/room/{room_name}/presence", dependencies=[Depends(fastapi_users.current_user())],
+            response_model=RoomPresence)
+async def get_room_presence(room_name: str):
+    """
+    Get the users connected to the room
+    """
+    return RoomPresence(room_name=room_name, room_active=presence.is_room_active(room_name),
+                        online=presence.room_members(room_name))
+
+
 @router.delete("/room/{room_name}", dependencies=[Depends(fastapi_users.current_user())])
 async def delete_room_by_room_name(room_name: str, session: AsyncSession = Depends(get_async_session)):
     """
@@ -84,24 +141,29 @@ async def delete_room_by_room_name(room_name: str, session: AsyncSession = Depen
 
 
 @router.get("/favorites")
-async def get_favorite_rooms(page: int = 1, limit: int = 10, session: AsyncSession = Depends(get_async_session),
+async def get_favorite_rooms(cursor: Optional[str] = None, limit: int = ROOM_PAGE_SIZE,
+                             session: AsyncSession = Depends(get_async_session),
                              current_user: UserRead = Depends(fastapi_users.current_user())):
     """
     Get favorites Room objects from a user
     """
-    rooms = await get_user_favorite(session, current_user.id, page, limit)
-    return rooms
+    try:
+        return await get_user_favorite(session, current_user.id, cursor, limit)
+    except (ValueError, TypeError):
+        raise _bad_cursor()
 
 
 @router.get("/favorite/{room_name}")
-async def get_favorite_rooms_by_room_name(room_name: str, page: int = 1, limit: int = 10,
+async def get_favorite_rooms_by_room_name(room_name: str, cursor: Optional[str] = None, limit: int = ROOM_PAGE_SIZE,
                                           session: AsyncSession = Depends(get_async_session),
                                           current_user: UserRead = Depends(fastapi_users.current_user())):
     """
     Get favorites Room objects from a user
     """
-    rooms = await get_user_favorite_like_room_name(session, room_name, current_user.id, page, limit)
-    return rooms
+    try:
+        return await get_user_favorite_like_room_name(session, room_name, current_user.id, cursor, limit)
+    except (ValueError, TypeError):
+        raise _bad_cursor()
 
 
 @router.post("/favorite")
@@ -1,10 +1,10 @@
 import datetime
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel
 
 from message.schemas import MessageRead
-from user.schemas import UserReadRequest
+from user.schemas import UserReadRequest, UserBaseReadRequest
 
 
 class RoomBaseRequest(BaseModel):
@@ -27,6 +27,16 @@ class RoomBaseInfoForAllUserRequest(RoomBaseInfoForUserRequest):
     is_owner: bool
 
 
+class RoomPage(BaseModel):
+    rooms: List[RoomBaseInfoForUserRequest]
+    next_cursor: Optional[str] = None
+
+
+class FavoriteRoomPage(BaseModel):
+    rooms: List[RoomBaseInfoForAllUserRequest]
+    next_cursor: Optional[str] = None
+
+
 class RoomReadRequest(RoomBaseInfoRequest):
     members: List[UserReadRequest]
     messages: List[MessageRead]
@@ -34,6 +44,24 @@ class RoomReadRequest(RoomBaseInfoRequest):
     room_creation_date: datetime.datetime
 
 
+class RoomSnapshot(RoomBaseInfoRequest):
+    room_active: bool
+    room_creation_date: datetime.datetime
+    # history cursor of the newest message by (creation_date, message_id); pass it as "after" to
+    # /room/{room_name}/messages to fetch what was posted since. None for a room without messages
+    room_version: Optional[str] = None
+    member_count: int
+    members: List[UserBaseReadRequest]
+    messages: List[MessageRead]
+    older_cursor: Optional[str] = None
+
+
+class RoomPresence(BaseModel):
+    room_name: str
+    room_active: bool
+    online: List[str]
+
+
 class FavoriteRequest(BaseModel):
     room_name: str
     is_chosen: bool
@@ -0,0 +1,23 @@
+from typing import List
+
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.models import room
+
+
+def _escape_like(value: str) -> str:
+    # backslash is Postgres' default LIKE escape, a pattern without ESCAPE keeps its prefix indexable
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+async def complete_room_names(session: AsyncSession, prefix: str, limit: int) -> List[str]:
+    """Room names starting with the prefix (case-insensitive), read through idx_room__room_name_prefix"""
+    folded = func.lower(room.c.room_name)
+    result = await session.execute(
+        select(room.c.room_name)
+        .where(folded.like(f'{_escape_like(prefix.lower())}%'))
+        .order_by(folded)
+        .limit(limit)
+    )
+    return [name for name, in result.fetchall()]
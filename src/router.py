@@ -1,5 +1,8 @@
 from fastapi import APIRouter
 
+import aws.router as aws_router
+import message.router as message_router
+import monitoring.router as monitoring_router
 import room.router as room_router
 import user.router as user_router
 from auth.base_config import auth_backend, fastapi_users
@@ -30,3 +33,12 @@ router.include_router(user_router.router, prefix="/user", tags=["users"])
 
 # rooms
 router.include_router(room_router.router, tags=["rooms"])
+
+# files
+router.include_router(aws_router.router, tags=["files"])
+
+# background processing of file messages
+router.include_router(message_router.jobs_router, tags=["chat"])
+
+# monitoring
+router.include_router(monitoring_router.router, prefix="/monitoring", tags=["monitoring"])
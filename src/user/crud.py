@@ -1,12 +1,13 @@
 import logging
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from fastapi import UploadFile
-from sqlalchemy import select, update
+from sqlalchemy import select, update, func
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.schemas import UserRead
-from aws.service import upload, get_url
+from aws.service import upload
+from aws.utils import media_url, media_urls
 from models.models import user, room_user
 from user.schemas import UserReadRequest, UserBaseReadRequest
 
@@ -20,7 +21,7 @@ async def get_user_by_id(session: AsyncSession, user_id: int) -> UserReadRequest
         user_id=user_instance.id,
         username=user_instance.username,
         email=user_instance.email,
-        profile_pic_img_src=user_instance.image_url
+        image_url=media_url(user_instance.image_url)
     )
 
 
@@ -31,7 +32,7 @@ async def get_user_by_username(session: AsyncSession, username: str) -> UserRead
         user_id=user_instance.id,
         username=user_instance.username,
         email=user_instance.email,
-        profile_pic_img_src=user_instance.image_url
+        image_url=media_url(user_instance.image_url)
     )
 
 
@@ -42,31 +43,54 @@ async def get_users_in_room(session: AsyncSession, room_id: int) -> List[UserRea
         .where(room_user.c.room == room_id)
     )
     rows = result.fetchall()
+    urls = media_urls(row[4] for row in rows)
     users: List[UserReadRequest] = list()
     for row in rows:
         users.append(UserReadRequest(
             user_id=row[0],
             username=row[1],
             email=row[2],
-            image_url=row[4]
+            image_url=urls.get(row[4])
         ))
     await session.commit()
     return users
 
 
+async def get_member_summary(session: AsyncSession, room_id: int, limit: int) \
+        -> Tuple[int, List[UserBaseReadRequest]]:
+    """
+    Member count of a room and its most recently active members, without emails
+    """
+    count = (await session.execute(
+        select(func.count()).select_from(room_user).where(room_user.c.room == room_id)
+    )).scalar_one()
+    result = await session.execute(
+        select(user.c.id, user.c.username, user.c.image_url)
+        .join(room_user, user.c.id == room_user.c.user)
+        .where(room_user.c.room == room_id)
+        .order_by(room_user.c.is_active.desc(), func.coalesce(room_user.c.update_date, room_user.c.creation_date).desc())
+        .limit(limit)
+    )
+    rows = result.fetchall()
+    urls = media_urls(row.image_url for row in rows)
+    members = [UserBaseReadRequest(user_id=row.id, username=row.username, image_url=urls.get(row.image_url))
+               for row in rows]
+    return count, members
+
+
 async def update_user_image(
         session: AsyncSession, current_user: UserRead, file: Optional[UploadFile]
 ) -> Optional[UserBaseReadRequest]:
     try:
         file_to_name = await upload(file)
-        image_url = await get_url(file_to_name.file_name)
+        # the object key is stored, a presigned URL would expire
         await session.execute(
             update(user)
             .where(user.c.id == current_user.id)
-            .values(image_url=image_url))
+            .values(image_url=file_to_name.file_name))
         await session.commit()
         return UserBaseReadRequest(user_id=current_user.id, username=current_user.username,
-                                   image_url=current_user.image_url)
+                                   image_url=media_url(file_to_name.file_name))
     except Exception as e:
         logger.error(f"Error updating user: {e}")
         await session.rollback()
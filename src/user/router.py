@@ -6,8 +6,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from auth.base_config import fastapi_users
 from auth.schemas import UserRead
 from database import get_async_session
+from presence import presence
 from user.crud import update_user_image
-from user.schemas import UserBaseReadRequest
+from user.schemas import UserBaseReadRequest, UserPresence
 
 router = APIRouter()
 
@@ -22,3 +23,13 @@ async def upload_profile_picture(
     Upload a profile picture for the current user
     """
     return await update_user_image(session, current_user, file)
+
+
+@router.get("/presence/{username}", dependencies=[Depends(fastapi_users.current_user())],
+            response_model=UserPresence)
+async def get_user_presence(username: str):
+    """
+    Get the rooms the user is connected to
+    """
+    rooms = presence.user_rooms(username)
+    return UserPresence(username=username, online=bool(rooms), rooms=rooms)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -32,3 +32,9 @@ class UserUpdateRequest(BaseModel):
     last_name: str
     first_name: str
     surname: str
+
+
+class UserPresence(BaseModel):
+    username: str
+    online: bool
+    rooms: List[str]